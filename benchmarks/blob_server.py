@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- mode:python -*-
+
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""A local stand-in for the GCS HTTP endpoint used by wjet and git-cs.
+
+Serves GET (with Range and, optionally, gzip Content-Encoding), HEAD and PUT
+of the files under a root dir, i.e. http://host:port/bucket/x.blob maps to
+root/bucket/x.blob. Latency, bandwidth and errors can be injected, to
+reproduce the network conditions the tools are tuned for.
+
+Usage: benchmarks/blob_server.py [--port=8080] [--latency-ms=20] ... root_dir
+Or, from python: server = BlobServer(root_dir, latency=0.02); server.Start()
+"""
+
+import BaseHTTPServer
+import gzip
+import optparse
+import os
+import random
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+import urllib
+
+
+class BlobServerOptions(object):
+  def __init__(self, latency=0, bandwidth=0, gzip_level=0, error_rate=0,
+               stall_rate=0, seed=0):
+    self.latency = latency  # Seconds added before each response.
+    self.bandwidth = bandwidth  # Bytes/s per connection, 0 = unlimited.
+    self.gzip_level = gzip_level  # 0 = never gzip the responses.
+    self.error_rate = error_rate  # Fraction of requests failing with 503.
+    self.stall_rate = stall_rate  # Fraction of responses hanging mid-body.
+    self.seed = seed
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'  # i.e. keep-alive.
+  IO_BLOCK_SIZE = 16384
+
+  def log_message(self, *_):
+    pass
+
+  def _GetPath(self):
+    rel_path = urllib.unquote(self.path.split('?', 1)[0]).lstrip('/')
+    path = os.path.normpath(os.path.join(self.server.root_dir, rel_path))
+    if not path.startswith(self.server.root_dir + os.sep):
+      return None
+    return path
+
+  def _Reply(self, status, body='', headers=None):
+    self.send_response(status)
+    for key, value in (headers or {}).iteritems():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if self.command == 'HEAD':
+      return
+    opts = self.server.options
+    stall = self.server.Random() < opts.stall_rate
+    for pos in xrange(0, len(body), self.IO_BLOCK_SIZE):
+      block = body[pos:pos + self.IO_BLOCK_SIZE]
+      if stall and pos >= len(body) / 2:
+        time.sleep(3600)  # The client is expected to time out.
+      self.wfile.write(block)
+      if opts.bandwidth:
+        time.sleep(float(len(block)) / opts.bandwidth)
+
+  def _Prologue(self):
+    """Returns False if the request has been failed by error injection."""
+    self.server.Count('requests')
+    opts = self.server.options
+    if opts.latency:
+      time.sleep(opts.latency)
+    if self.server.Random() < opts.error_rate:
+      self.server.Count('injected_errors')
+      self._Reply(503, 'Injected error')
+      return False
+    return True
+
+  def do_GET(self):
+    if not self._Prologue():
+      return
+    path = self._GetPath()
+    if not path or not os.path.isfile(path):
+      return self._Reply(404, 'Not found')
+    with open(path, 'rb') as fd:
+      data = fd.read()
+    headers = {}
+    status = 200
+    range_hdr = self.headers.get('Range')
+    if range_hdr and range_hdr.startswith('bytes='):
+      start, end = range_hdr[6:].split('-')
+      start = int(start)
+      end = int(end) if end else len(data) - 1
+      if start >= len(data):
+        return self._Reply(416, '')
+      headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+      data = data[start:end + 1]
+      status = 206
+    elif (self.server.options.gzip_level and
+          'gzip' in self.headers.get('Accept-Encoding', '')):
+      buf = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=buf, mode='wb',
+                         compresslevel=self.server.options.gzip_level) as gz:
+        gz.write(data)
+      data = buf.getvalue()
+      headers['Content-Encoding'] = 'gzip'
+    self.server.Count('bytes_sent', len(data))
+    self._Reply(status, data, headers)
+
+  def do_HEAD(self):
+    if not self._Prologue():
+      return
+    path = self._GetPath()
+    self._Reply(200 if path and os.path.isfile(path) else 404)
+
+  def do_PUT(self):
+    if not self._Prologue():
+      return
+    path = self._GetPath()
+    data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if not path:
+      return self._Reply(403, 'Forbidden')
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    tmp_path = '%s.tmp%d' % (path, threading.current_thread().ident)
+    with open(tmp_path, 'wb') as fd:
+      fd.write(data)
+    os.rename(tmp_path, path)
+    self.server.Count('bytes_received', len(data))
+    self._Reply(200)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  request_queue_size = 256
+
+  def __init__(self, address, root_dir, options):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+    self.root_dir = os.path.abspath(root_dir)
+    self.options = options
+    self.counters = {}
+    self._lock = threading.Lock()
+    self._random = random.Random(options.seed)
+
+  def Random(self):
+    with self._lock:
+      return self._random.random()
+
+  def Count(self, counter, value=1):
+    with self._lock:
+      self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+class BlobServer(object):
+  """Runs the stand-in server on a background thread."""
+
+  def __init__(self, root_dir, port=0, **kwargs):
+    self._server = _Server(('127.0.0.1', port), root_dir,
+                           BlobServerOptions(**kwargs))
+    self._thread = None
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+  @property
+  def counters(self):
+    return dict(self._server.counters)
+
+  def ResetCounters(self):
+    self._server.counters = {}
+
+  def Start(self):
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def Stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] root_dir')
+  parser.add_option('--port', type='int', default=8080)
+  parser.add_option('--latency-ms', type='float', default=0,
+                    help='Delay added to each request')
+  parser.add_option('--bandwidth-mbps', type='float', default=0,
+                    help='Per-connection bandwidth, in MB/s (0: unlimited)')
+  parser.add_option('--gzip', type='int', default=0, metavar='LEVEL',
+                    help='gzip level of the responses (0: no gzip)')
+  parser.add_option('--error-rate', type='float', default=0,
+                    help='Fraction of requests failing with 503')
+  parser.add_option('--stall-rate', type='float', default=0,
+                    help='Fraction of responses hanging half-way')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    parser.print_usage()
+    return 1
+  server = _Server(('127.0.0.1', options.port), args[0], BlobServerOptions(
+      latency=options.latency_ms / 1000.0,
+      bandwidth=options.bandwidth_mbps * 1048576,
+      gzip_level=options.gzip, error_rate=options.error_rate,
+      stall_rate=options.stall_rate))
+  print 'Serving %s on http://127.0.0.1:%d' % (args[0], options.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- mode:python -*-
+
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Runs named end-to-end benchmark scenarios and reports the results as JSON.
+
+The inputs are generated by synthetic.py (deterministically, so that runs are
+comparable) and the GCS endpoint is replaced by a local BlobServer, whose
+latency, bandwidth, gzip and error rate are configurable. Each scenario is run
+--repeat times and the fastest run is reported.
+
+Usage: benchmarks/run.py [--scenarios=a,b] [-o results.json]
+       benchmarks/run.py --baseline=baseline.json [...]  # Compare mode.
+"""
+
+import collections
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import blob_server
+import synthetic
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_GIT_CS = os.path.join(_ROOT_DIR, 'git-cs')
+_INSPECT_PACKS = os.path.join(_ROOT_DIR, 'git-inspect-packs')
+_HISTORY_REWRITE_DIR = os.path.join(_ROOT_DIR, 'history-rewrite')
+
+_RESULTS_FORMAT = 1
+
+
+def _Log(msg):
+  print >>sys.stderr, msg
+
+
+def _RunTool(cmd, cwd, env=None):
+  """Runs a python tool with its output discarded. Returns the elapsed secs."""
+  full_env = dict(os.environ)
+  full_env.update(env or {})
+  with open(os.devnull, 'w') as devnull:
+    tstart = time.time()
+    ret = subprocess.call([sys.executable] + cmd, cwd=cwd, env=full_env,
+                          stdout=devnull, stderr=devnull)
+    elapsed = time.time() - tstart
+  if ret != 0:
+    raise Exception('%s failed (ret: %d)' % (' '.join(cmd), ret))
+  return elapsed
+
+
+class _Context(object):
+  """Holds the options and the fixtures, which are shared by the scenarios."""
+
+  def __init__(self, options, work_dir):
+    self.options = options
+    self.work_dir = work_dir
+    self._fixtures = {}
+    self._servers = []
+
+  def Path(self, *parts):
+    return os.path.join(self.work_dir, *parts)
+
+  def Fixture(self, name, builder):
+    if name not in self._fixtures:
+      _Log('  Generating %s...' % name)
+      self._fixtures[name] = builder()
+    return self._fixtures[name]
+
+  def GitcsCheckout(self):
+    """Returns (checkout_dir, num_files, total_size, BlobServer)."""
+    def _Build():
+      opts = self.options
+      size = synthetic.MakeGitcsCheckout(
+          self.Path('gitcs'), self.Path('blobs'), files=opts.gitcs_files,
+          file_size=opts.gitcs_file_size)
+      server = blob_server.BlobServer(
+          self.Path('blobs'), latency=opts.latency_ms / 1000.0,
+          bandwidth=opts.bandwidth_mbps * 1048576, gzip_level=opts.gzip,
+          error_rate=opts.error_rate).Start()
+      self._servers.append(server)
+      return self.Path('gitcs'), opts.gitcs_files, size, server
+    return self.Fixture('gitcs checkout', _Build)
+
+  def PackedRepo(self):
+    def _Build():
+      shape = synthetic.RepoShape(commits=sys.maxint,
+                                  max_objects=self.options.pack_objects, seed=1)
+      synthetic.MakeRepo(self.Path('packed'), shape)
+      return synthetic.MakePacks(self.Path('packed'))
+    return self.Fixture('packed repo', _Build)
+
+  def RewriteRepo(self):
+    def _Build():
+      # Only the binaries under a *Tests dir are moved out of the trees.
+      shape = synthetic.RepoShape(commits=self.options.rewrite_commits,
+                                  binary_ratio=0.2, tests_dir='LayoutTests',
+                                  seed=2)
+      synthetic.MakeRepo(self.Path('rewrite-src'), shape)
+      return self.Path('rewrite-src')
+    return self.Fixture('rewrite repo', _Build)
+
+  def Close(self):
+    for server in self._servers:
+      server.Stop()
+
+
+def _ResetGitcsCheckout(checkout, cache_dir, keep_cache):
+  """Removes the synced binaries, the SHA-1 index and (maybe) the cache."""
+  for dirpath, dirnames, filenames in os.walk(checkout):
+    if '.git' in dirnames:
+      dirnames.remove('.git')
+    for filename in filenames:
+      if filename.endswith('.png'):
+        os.remove(os.path.join(dirpath, filename))
+  index_path = os.path.join(checkout, '.git', 'gitcs-index')
+  if os.path.exists(index_path):
+    os.remove(index_path)
+  if not keep_cache and os.path.isdir(cache_dir):
+    shutil.rmtree(cache_dir)
+
+
+def _GitcsEnv(ctx, server):
+  return {'GITCS_BASE_URL': server.url,
+          'GITCS_CACHE_DIR': ctx.Path('gitcs-cache'),
+          'GITCS_WALKER': ctx.options.gitcs_walker}
+
+
+def _GitcsSync(ctx, warm):
+  checkout, num_files, total_size, server = ctx.GitcsCheckout()
+  env = _GitcsEnv(ctx, server)
+  _ResetGitcsCheckout(checkout, env['GITCS_CACHE_DIR'], keep_cache=False)
+  if warm:
+    # Populate the cache, then drop the binaries (e.g., a branch switch).
+    _RunTool([_GIT_CS, 'sync'], checkout, env)
+    _ResetGitcsCheckout(checkout, env['GITCS_CACHE_DIR'], keep_cache=True)
+  server.ResetCounters()
+  secs = _RunTool([_GIT_CS, 'sync'], checkout, env)
+  counters = server.counters
+  return {'secs': secs, 'files_per_sec': num_files / secs,
+          'mb_per_sec': total_size / 1048576.0 / secs,
+          'requests': counters.get('requests', 0),
+          'injected_errors': counters.get('injected_errors', 0)}
+
+
+def _GitcsSyncCold(ctx):
+  """git-cs sync of a fresh checkout, with an empty cache."""
+  return _GitcsSync(ctx, warm=False)
+
+
+def _GitcsSyncWarm(ctx):
+  """git-cs sync of a checkout whose binaries are all in the cache."""
+  return _GitcsSync(ctx, warm=True)
+
+
+def _GitcsStatusNoop(ctx):
+  """git-cs status of a fully synced checkout, nothing to report."""
+  checkout, num_files, _, server = ctx.GitcsCheckout()
+  env = _GitcsEnv(ctx, server)
+  if not os.path.exists(os.path.join(checkout, '.git', 'gitcs-index')):
+    _RunTool([_GIT_CS, 'sync'], checkout, env)
+  secs = _RunTool([_GIT_CS, 'status'], checkout, env)
+  return {'secs': secs, 'files_per_sec': num_files / secs}
+
+
+def _InspectPacks(ctx, cached):
+  pack_dir = ctx.PackedRepo()
+  num_objects = synthetic.CountObjects(os.path.dirname(os.path.dirname(
+      pack_dir)))
+  cmd = [_INSPECT_PACKS, '--pack-dir', pack_dir, '--pack-stats']
+  if cached:
+    _RunTool(cmd, pack_dir)  # Creates the analysis cache.
+  else:
+    cmd.append('--no-cache')
+  secs = _RunTool(cmd, pack_dir)
+  return {'secs': secs, 'objects': num_objects,
+          'objects_per_sec': num_objects / secs}
+
+
+def _InspectPacksCold(ctx):
+  """git-inspect-packs --pack-stats on --pack-objects objects."""
+  return _InspectPacks(ctx, cached=False)
+
+
+def _InspectPacksCached(ctx):
+  """As above, but from the analysis cache of a previous run."""
+  return _InspectPacks(ctx, cached=True)
+
+
+def _RewriteChild(src_repo, out_dir, args, queue):
+  """Runs blink_history_rewrite.main() in a fresh process, timing its steps."""
+  try:
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.chdir(src_repo)
+    sys.path.insert(0, _HISTORY_REWRITE_DIR)
+    import blink_history_rewrite as rewrite
+    rewrite.DIRS.NEWOBJS = os.path.join(out_dir, 'objects') + '/'
+    rewrite.DIRS.GCS = os.path.join(out_dir, 'gcs') + '/'
+    rewrite.DIRS.STATE = os.path.join(out_dir, 'state') + '/'
+    timings = {}
+
+    def _Timed(name, fn):
+      def _Wrapper(items, *args):
+        tstart = time.time()
+        ret = fn(items, *args)
+        timings[name] = (time.time() - tstart, len(items))
+        return ret
+      return _Wrapper
+
+    rewrite._RewriteTrees = _Timed('trees', rewrite._RewriteTrees)
+    rewrite._RewriteCommits = _Timed('commits', rewrite._RewriteCommits)
+    sys.argv = ['blink_history_rewrite.py', '--from-scratch'] + args
+    rewrite.main()
+    queue.put(timings)
+  except Exception:
+    queue.put(traceback.format_exc())
+
+
+def _Rewrite(ctx, args):
+  src_repo = ctx.RewriteRepo()
+  out_dir = ctx.Path('rewrite-out')
+  if os.path.isdir(out_dir):
+    shutil.rmtree(out_dir)
+  queue = multiprocessing.Queue()
+  tstart = time.time()
+  proc = multiprocessing.Process(target=_RewriteChild,
+                                 args=(src_repo, out_dir, args, queue))
+  proc.start()
+  timings = queue.get()
+  proc.join()
+  secs = time.time() - tstart
+  if not isinstance(timings, dict):
+    raise Exception('The rewrite failed:\n' + timings)
+  # Each root tree is rewritten recursively, the rates are per root tree.
+  trees_secs, num_trees = timings['trees']
+  commits_secs, num_commits = timings['commits']
+  num_blobs = len(os.listdir(os.path.join(out_dir, 'gcs')))
+  if not num_blobs:
+    raise Exception('The rewrite moved no binaries out of the trees')
+  return {'secs': secs, 'root_trees': num_trees, 'commits': num_commits,
+          'gcs_blobs': num_blobs,
+          'root_trees_per_sec': num_trees / trees_secs,
+          'commits_per_sec': num_commits / commits_secs}
+
+
+def _RewriteLoose(ctx):
+  """blink_history_rewrite of --rewrite-commits commits, loose objects."""
+  return _Rewrite(ctx, [])
+
+
+def _RewritePacks(ctx):
+  """As above, writing packs (--packs)."""
+  return _Rewrite(ctx, ['--packs'])
+
+
+_SCENARIOS = collections.OrderedDict((
+    ('gitcs-sync-cold', _GitcsSyncCold),
+    ('gitcs-sync-warm', _GitcsSyncWarm),
+    ('gitcs-status-noop', _GitcsStatusNoop),
+    ('inspect-packs', _InspectPacksCold),
+    ('inspect-packs-cached', _InspectPacksCached),
+    ('rewrite', _RewriteLoose),
+    ('rewrite-packs', _RewritePacks),
+))
+
+
+def _IsBetter(metric, value, baseline):
+  """Returns True/False if value is better/worse than baseline, None if the
+  metric has no direction (e.g., counts)."""
+  if metric == 'secs':
+    return value < baseline
+  if metric.endswith('_per_sec'):
+    return value > baseline
+  return None
+
+
+def _Compare(results, baseline, threshold):
+  """Prints the changes vs baseline. Returns the number of regressions."""
+  if results['params'] != baseline.get('params'):
+    _Log('WARNING: the baseline was run with different parameters.')
+  regressions = 0
+  print '%-22s %-16s %12s %12s %8s' % ('scenario', 'metric', 'baseline',
+                                       'current', 'change')
+  for scenario, metrics in results['results'].iteritems():
+    base_metrics = baseline['results'].get(scenario)
+    if base_metrics is None:
+      print '%-22s (not in the baseline)' % scenario
+      continue
+    for metric, value in sorted(metrics.iteritems()):
+      base_value = base_metrics.get(metric)
+      if not base_value:
+        continue
+      change = float(value) / base_value - 1
+      verdict = ''
+      if abs(change) > threshold and _IsBetter(metric, value,
+                                               base_value) is not None:
+        if _IsBetter(metric, value, base_value):
+          verdict = 'better'
+        else:
+          verdict = 'REGRESSION'
+          regressions += 1
+      print '%-22s %-16s %12.2f %12.2f %+7.1f%% %s' % (
+          scenario, metric, base_value, value, change * 100, verdict)
+  return regressions
+
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__.split('Usage: ')[1].strip())
+  parser.add_option('--scenarios', default=','.join(_SCENARIOS),
+                    help='Comma-separated (default: all). See --list')
+  parser.add_option('--list', action='store_true', default=False,
+                    help='List the scenarios and exit')
+  parser.add_option('--repeat', type='int', default=3)
+  parser.add_option('-o', '--output', help='Write the results (JSON) here')
+  parser.add_option('--baseline',
+                    help='Compare against these (JSON) results. Exits 1 on '
+                    'regressions')
+  parser.add_option('--threshold', type='float', default=0.1,
+                    help='Relative change reported as regression or '
+                    'improvement (default: %default)')
+  parser.add_option('--work-dir', help='Where to generate the inputs '
+                    '(default: a temporary dir, deleted on exit)')
+  group = optparse.OptionGroup(parser, 'Inputs')
+  group.add_option('--gitcs-files', type='int', default=2000)
+  group.add_option('--gitcs-file-size', type='int', default=16384)
+  group.add_option('--gitcs-walker', choices=('os', 'parallel', 'git'),
+                   default='os',
+                   help='git-cs --walker for the gitcs-* scenarios (default: '
+                   '%default)')
+  group.add_option('--pack-objects', type='int', default=100000,
+                   help='e.g., 2000000 for a Blink-sized pack')
+  group.add_option('--rewrite-commits', type='int', default=500)
+  parser.add_option_group(group)
+  group = optparse.OptionGroup(parser, 'Blob server')
+  group.add_option('--latency-ms', type='float', default=5)
+  group.add_option('--bandwidth-mbps', type='float', default=0,
+                   help='Per connection, 0: unlimited')
+  group.add_option('--gzip', type='int', default=0, metavar='LEVEL')
+  group.add_option('--error-rate', type='float', default=0)
+  parser.add_option_group(group)
+  options, _ = parser.parse_args()
+
+  if options.list:
+    for name, fn in _SCENARIOS.iteritems():
+      print '%-22s %s' % (name, fn.__doc__)
+    return 0
+  scenarios = options.scenarios.split(',')
+  for name in scenarios:
+    if name not in _SCENARIOS:
+      parser.error('Unknown scenario ' + name)
+
+  work_dir = options.work_dir or tempfile.mkdtemp(prefix='git-tools-bench-')
+  ctx = _Context(options, work_dir)
+  results = {
+      'format': _RESULTS_FORMAT,
+      'env': {
+          'python': platform.python_version(),
+          'platform': platform.platform(),
+          'cpus': multiprocessing.cpu_count(),
+          'git': subprocess.check_output(['git', '--version']).strip(),
+          'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+      },
+      'params': dict((key, getattr(options, key)) for key in (
+          'gitcs_files', 'gitcs_file_size', 'gitcs_walker', 'pack_objects',
+          'rewrite_commits', 'latency_ms', 'bandwidth_mbps', 'gzip',
+          'error_rate')),
+      'results': collections.OrderedDict(),
+  }
+  try:
+    for name in scenarios:
+      _Log('Running %s' % name)
+      runs = [_SCENARIOS[name](ctx) for _ in xrange(options.repeat)]
+      best = min(runs, key=lambda run: run['secs'])
+      _Log('  %.2fs (best of %d)' % (best['secs'], len(runs)))
+      results['results'][name] = best
+  finally:
+    ctx.Close()
+    if not options.work_dir:
+      shutil.rmtree(work_dir)
+
+  output = json.dumps(results, indent=2)
+  if options.output:
+    with open(options.output, 'w') as out_fd:
+      out_fd.write(output + '\n')
+  elif not options.baseline:
+    print output
+  if options.baseline:
+    with open(options.baseline) as baseline_fd:
+      baseline = json.load(baseline_fd)
+    if _Compare(results, baseline, options.threshold):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- mode:python -*-
+
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Generators of synthetic git repos, packs and git-cs checkouts.
+
+Everything is derived from a seed (contents, names and timestamps), hence the
+same parameters always produce the same objects (i.e., the same SHA-1s), which
+makes benchmark results comparable across runs and machines.
+
+Usage: benchmarks/synthetic.py repo [--commits=1000] [...] out_dir
+       benchmarks/synthetic.py gitcs [--files=10000] [...] out_dir blob_dir
+"""
+
+import hashlib
+import optparse
+import os
+import random
+import subprocess
+import sys
+
+_BASE_TIMESTAMP = 1400000000
+
+
+class RepoShape(object):
+  """The knobs of the synthetic repos.
+
+  depth and dirs control deep vs wide trees, binary_ratio the share of binary
+  (.png) files and changes_per_commit how delta-heavy the history is: text
+  files are modified in place (a few lines per change) while binaries are
+  rewritten from scratch. If max_objects is set, the history stops as soon
+  as it reaches that many objects. If tests_dir is set (e.g., 'LayoutTests'),
+  the files are generated under it, which blink_history_rewrite needs in order
+  to move the binaries out of the trees.
+  """
+
+  def __init__(self, commits=1000, dirs=50, depth=3, files_per_dir=20,
+               binary_ratio=0.1, binary_size=16384, text_lines=200,
+               changes_per_commit=4, max_objects=None, tests_dir=None,
+               seed=0):
+    self.commits = commits
+    self.max_objects = max_objects
+    self.dirs = dirs
+    self.depth = depth
+    self.files_per_dir = files_per_dir
+    self.binary_ratio = binary_ratio
+    self.binary_size = binary_size
+    self.text_lines = text_lines
+    self.changes_per_commit = changes_per_commit
+    self.tests_dir = tests_dir
+    self.seed = seed
+
+
+def _DirPath(shape, dir_index):
+  """Directory dir_index, nested shape.depth levels deep."""
+  parts = ['d%d' % ((dir_index >> (4 * level)) % 16)
+           for level in xrange(shape.depth - 1, 0, -1)]
+  if shape.tests_dir:
+    parts.insert(0, shape.tests_dir)
+  return '/'.join(parts + ['dir%04d' % dir_index])
+
+
+def _TextLines(rnd, num_lines):
+  return ['%06d %x' % (i, rnd.getrandbits(64)) for i in xrange(num_lines)]
+
+
+def _RandomBytes(rnd, size):
+  if not size:
+    return ''
+  return ('%0*x' % (size * 2, rnd.getrandbits(size * 8))).decode('hex')
+
+
+def _CountNewObjects(paths):
+  """Returns the number of objects a commit changing paths introduces: the
+  commit itself, the blobs and all the trees up to the root."""
+  trees = set([''])
+  for path in paths:
+    while '/' in path:
+      path = path.rsplit('/', 1)[0]
+      trees.add(path)
+  return 1 + len(paths) + len(trees)
+
+
+def _GitBlobSHA1(data):
+  return hashlib.sha1('blob %d\x00%s' % (len(data), data)).hexdigest()
+
+
+def MakeRepo(path, shape, branch='master'):
+  """Creates (via git fast-import) a repo with shape.commits commits.
+
+  Returns the SHA-1 of the head commit.
+  """
+  rnd = random.Random(shape.seed)
+  subprocess.check_call(['git', 'init', '-q', path])
+  proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                          stdin=subprocess.PIPE)
+  out = proc.stdin
+  files = {}  # path -> list of lines (text) or None (binary).
+  for dir_index in xrange(shape.dirs):
+    dir_path = _DirPath(shape, dir_index)
+    for i in xrange(shape.files_per_dir):
+      if rnd.random() < shape.binary_ratio:
+        files['%s/img%03d.png' % (dir_path, i)] = None
+      else:
+        files['%s/file%03d.txt' % (dir_path, i)] = _TextLines(
+            rnd, shape.text_lines)
+  paths = sorted(files)
+
+  def _WriteFile(file_path):
+    lines = files[file_path]
+    if lines is None:
+      data = _RandomBytes(rnd, shape.binary_size)
+    else:
+      data = '\n'.join(lines) + '\n'
+    out.write('M 100644 inline %s\ndata %d\n%s\n' % (file_path, len(data),
+                                                      data))
+
+  num_objects = 0
+  for commit in xrange(shape.commits):
+    if shape.max_objects and num_objects >= shape.max_objects:
+      break
+    timestamp = _BASE_TIMESTAMP + commit * 60
+    msg = 'Synthetic commit %d\n' % commit
+    out.write('commit refs/heads/%s\n' % branch)
+    out.write('committer Bench <bench@example.com> %d +0000\n' % timestamp)
+    out.write('data %d\n%s' % (len(msg), msg))
+    if commit == 0:
+      for file_path in paths:
+        _WriteFile(file_path)
+      num_objects += _CountNewObjects(paths)
+      continue
+    changed = set()
+    for _ in xrange(shape.changes_per_commit):
+      file_path = paths[rnd.randrange(len(paths))]
+      changed.add(file_path)
+      lines = files[file_path]
+      if lines is not None:
+        for _ in xrange(3):
+          lines[rnd.randrange(len(lines))] = '%06d %x' % (
+              commit, rnd.getrandbits(64))
+      _WriteFile(file_path)
+    num_objects += _CountNewObjects(changed)
+  out.close()
+  if proc.wait() != 0:
+    raise Exception('git fast-import failed')
+  return subprocess.check_output(['git', 'rev-parse', branch],
+                                 cwd=path).strip()
+
+
+def MakePacks(repo_path, depth=50, window=10):
+  """Repacks everything in a single, delta-heavy, pack. Returns its dir."""
+  subprocess.check_call(['git', 'repack', '-q', '-a', '-d', '-f',
+                         '--depth=%d' % depth, '--window=%d' % window],
+                        cwd=repo_path)
+  git_dir = subprocess.check_output(['git', 'rev-parse', '--git-dir'],
+                                    cwd=repo_path).strip()
+  return os.path.join(repo_path, git_dir, 'objects', 'pack')
+
+
+def CountObjects(repo_path):
+  out = subprocess.check_output(['git', 'count-objects', '-v'], cwd=repo_path)
+  counts = dict(line.split(': ') for line in out.splitlines())
+  return int(counts['count']) + int(counts['in-pack'])
+
+
+def MakeGitcsCheckout(path, blob_dir, bucket='bench-bucket', files=10000,
+                      dirs=100, depth=3, file_size=16384, seed=0):
+  """Creates a git-cs checkout: .gitcs refs plus some regular files, committed
+  (so that the git walker, which lists the index, sees them).
+
+  The referenced blobs are written in blob_dir/bucket/, to be served by the
+  BlobServer. Returns the total size of the blobs.
+  """
+  rnd = random.Random(seed)
+  shape = RepoShape(dirs=dirs, depth=depth)
+  bucket_dir = os.path.join(blob_dir, bucket)
+  for dir_path in (path, bucket_dir):
+    if not os.path.isdir(dir_path):
+      os.makedirs(dir_path)
+  subprocess.check_call(['git', 'init', '-q', path])
+  total_size = 0
+  for i in xrange(files):
+    dir_path = os.path.join(path, _DirPath(shape, i % dirs))
+    if not os.path.isdir(dir_path):
+      os.makedirs(dir_path)
+    # Sizes vary around file_size, as real binaries do.
+    data = _RandomBytes(rnd, rnd.randint(file_size / 2, file_size * 3 / 2))
+    sha1 = _GitBlobSHA1(data)
+    with open(os.path.join(bucket_dir, sha1 + '.blob'), 'wb') as fd:
+      fd.write(data)
+    with open(os.path.join(dir_path, 'img%06d.png.gitcs' % i), 'w') as fd:
+      fd.write('src gs://%s/%s.blob\n' % (bucket, sha1))
+    with open(os.path.join(dir_path, 'file%06d.txt' % i), 'w') as fd:
+      fd.write('\n'.join(_TextLines(rnd, 4)))
+    total_size += len(data)
+  env = dict(os.environ)
+  for who in ('AUTHOR', 'COMMITTER'):
+    env.update({'GIT_%s_NAME' % who: 'Bench',
+                'GIT_%s_EMAIL' % who: 'bench@example.com',
+                'GIT_%s_DATE' % who: '%d +0000' % _BASE_TIMESTAMP})
+  subprocess.check_call(['git', 'add', '-A', '.'], cwd=path)
+  subprocess.check_call(['git', 'commit', '-q', '-m', 'Synthetic checkout'],
+                        cwd=path, env=env)
+  return total_size
+
+
+def main():
+  parser = optparse.OptionParser(usage=__doc__.split('Usage: ')[1].strip())
+  parser.add_option('--commits', type='int', default=1000)
+  parser.add_option('--dirs', type='int', default=50)
+  parser.add_option('--depth', type='int', default=3)
+  parser.add_option('--files-per-dir', type='int', default=20)
+  parser.add_option('--binary-ratio', type='float', default=0.1)
+  parser.add_option('--changes-per-commit', type='int', default=4)
+  parser.add_option('--tests-dir',
+                    help='repo: generate the files under this dir (e.g., '
+                    'LayoutTests, for blink_history_rewrite)')
+  parser.add_option('--max-objects', type='int',
+                    help='repo: stop the history at about this many objects')
+  parser.add_option('--repack', action='store_true', default=False,
+                    help='repo: repack into a single delta-heavy pack')
+  parser.add_option('--files', type='int', default=10000,
+                    help='gitcs: number of .gitcs refs')
+  parser.add_option('--seed', type='int', default=0)
+  options, args = parser.parse_args()
+
+  if len(args) == 2 and args[0] == 'repo':
+    shape = RepoShape(commits=options.commits, dirs=options.dirs,
+                      depth=options.depth,
+                      files_per_dir=options.files_per_dir,
+                      binary_ratio=options.binary_ratio,
+                      changes_per_commit=options.changes_per_commit,
+                      max_objects=options.max_objects,
+                      tests_dir=options.tests_dir, seed=options.seed)
+    print 'HEAD:', MakeRepo(args[1], shape)
+    if options.repack:
+      MakePacks(args[1])
+    print 'Objects:', CountObjects(args[1])
+  elif len(args) == 3 and args[0] == 'gitcs':
+    size = MakeGitcsCheckout(args[1], args[2], files=options.files,
+                             dirs=options.dirs, depth=options.depth,
+                             seed=options.seed)
+    print 'Blobs: %d, %.1f MB' % (options.files, size / 1048576.0)
+  else:
+    parser.print_usage()
+    return 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
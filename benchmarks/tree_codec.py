@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- mode:python -*-
+
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Micro-benchmarks of the tree codec (see gitutils.ParseGitTree & co.).
+
+The trees are synthetic (a mix of files and sub-trees, named so that the git
+"sub-trees sort as name + '/'" rule matters). Each codec function is checked
+against a straightforward reference implementation (or the code it replaced),
+which is also timed as a baseline, so that regressions show up as a shrinking
+speedup.
+
+Usage: benchmarks/tree_codec.py [--sizes=100,5000,50000] [--repeat=5]
+"""
+
+import hashlib
+import imp
+import optparse
+import os
+import random
+import sys
+import timeit
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_ROOT_DIR, 'history-rewrite'))
+import gitutils
+
+# git-inspect-packs is a script (no .py), load it as a module.
+inspect_packs = imp.load_source('inspect_packs',
+                                os.path.join(_ROOT_DIR, 'git-inspect-packs'))
+
+
+def _MakeTree(num_entries, seed=0):
+  """Returns the payload of a synthetic tree with num_entries entries."""
+  rnd = random.Random(seed)
+  entries = []
+  for i in xrange(num_entries):
+    sha1 = gitutils.SHA1(hashlib.sha1(str(i)).digest())
+    kind = rnd.randint(0, 9)
+    if kind == 0:
+      entries.append(('40000', 'dir%d' % (i / 3), sha1))
+    elif kind == 1:
+      entries.append(('100755', 'dir%d.sh' % (i / 3), sha1))
+    else:
+      fname = 'file%07d-%s.png' % (i, 'x' * rnd.randint(0, 30))
+      entries.append(('100644', fname, sha1))
+  # Names must be unique within a tree.
+  entries = dict((fname, (mode, fname, sha1))
+                 for mode, fname, sha1 in entries).values()
+  return _ReferenceEncode(entries)
+
+
+def _ReferenceParse(data):
+  entries = []
+  pos = 0
+  while pos < len(data):
+    space = data.index(' ', pos)
+    nul = data.index('\x00', space)
+    entries.append((data[pos:space], data[space + 1:nul],
+                    data[nul + 1:nul + 21]))
+    pos = nul + 21
+  return entries
+
+
+def _LegacyInspectPacksParseTree(data):
+  """The char-by-char parser git-inspect-packs used to have."""
+  children = {}
+  state = 0
+  fname = ''
+  child_sha = ''
+  for c in data:
+    if state == 0:
+      if c == ' ':
+        state = 1
+    elif state == 1:
+      if c != '\x00':
+        fname += c
+      else:
+        state = 2
+    else:
+      child_sha += c
+      if len(child_sha) == 20:
+        children[fname] = child_sha
+        fname = ''
+        child_sha = ''
+        state = 0
+  return children
+
+
+def _ReferenceEncode(entries):
+  def _SortKey(entry):
+    return entry[1] + '/' if entry[0][-5:-3] == '40' else entry[1]
+  payload = ''
+  for mode, fname, sha1 in sorted(entries, key=_SortKey):
+    payload += mode + ' ' + fname + '\x00' + sha1.raw
+  return payload
+
+
+def _Rename(entries):
+  """Mimics blink_history_rewrite: renames .png files into .png.gitcs."""
+  return [(mode, fname + '.gitcs' if fname.endswith('.png') else fname, sha1)
+          for mode, fname, sha1 in entries]
+
+
+def _Check(data):
+  reference = _ReferenceParse(data)
+  assert gitutils.ParseGitTreeRaw(data) == reference
+  assert [(mode, fname, sha1.raw) for mode, fname, sha1 in
+          gitutils.ParseGitTree(data)] == reference
+  assert gitutils.ParseGitTreeToDict(data) == dict(
+      (fname, sha) for _, fname, sha in reference)
+  assert inspect_packs.ParseTree(data) == _LegacyInspectPacksParseTree(data)
+  entries = gitutils.ParseGitTree(data)
+  assert gitutils.EncodeGitTree(entries) == data
+  shuffled = entries[:]
+  random.Random(1).shuffle(shuffled)
+  assert gitutils.EncodeGitTree(shuffled) == data
+  renamed = _Rename(entries)
+  assert gitutils.EncodeGitTree(renamed) == _ReferenceEncode(renamed)
+
+
+def _Benchmarks(data):
+  """Returns a list of (name, fn, baseline_fn)."""
+  entries = gitutils.ParseGitTree(data)
+  renamed = _Rename(entries)
+  return [
+      ('ParseGitTree', lambda: gitutils.ParseGitTree(data),
+       lambda: [(mode, fname, gitutils.SHA1(sha))
+                for mode, fname, sha in _ReferenceParse(data)]),
+      ('ParseGitTreeRaw', lambda: gitutils.ParseGitTreeRaw(data),
+       lambda: _ReferenceParse(data)),
+      ('inspect-packs ParseTree', lambda: inspect_packs.ParseTree(data),
+       lambda: _LegacyInspectPacksParseTree(data)),
+      ('EncodeGitTree (sorted)', lambda: gitutils.EncodeGitTree(entries),
+       lambda: _ReferenceEncode(entries)),
+      ('EncodeGitTree (renamed)', lambda: gitutils.EncodeGitTree(renamed),
+       lambda: _ReferenceEncode(renamed)),
+  ]
+
+
+def _Time(fn, repeat):
+  """Returns the best time (seconds) per call of fn."""
+  number = 1
+  while True:
+    elapsed = timeit.Timer(fn).timeit(number)
+    if elapsed > 0.05 or number >= 1 << 20:
+      break
+    number *= 4
+  return min(timeit.Timer(fn).repeat(repeat, number)) / number
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--sizes', default='100,5000,50000',
+                    help='Comma-separated number of entries of the trees')
+  parser.add_option('--repeat', type='int', default=5)
+  options, _ = parser.parse_args()
+
+  print '%-26s %8s %12s %12s %8s' % ('benchmark', 'entries', 'usec/call',
+                                     'baseline', 'speedup')
+  for size in [int(x) for x in options.sizes.split(',')]:
+    data = _MakeTree(size)
+    _Check(data)
+    for name, fn, baseline_fn in _Benchmarks(data):
+      secs = _Time(fn, options.repeat)
+      baseline_secs = _Time(baseline_fn, options.repeat)
+      print '%-26s %8d %12.1f %12.1f %7.1fx' % (
+          name, size, secs * 1e6, baseline_secs * 1e6, baseline_secs / secs)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -37,15 +37,24 @@ Furthermore, the /LayoutTests/.gitignore file is changed (or created) in order
 to add ignore the _BIN_EXTS below.
 """
 
+import collections
+import glob
+import hashlib
 import multiprocessing
+import multiprocessing.util
+import optparse
 import os
 import subprocess
 import sys
 import time
 import traceback
+import zlib
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 from gitutils import *
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                             os.pardir, 'instrument'))
+import instrument
 
 
 _SKIP_COPY_INTO_CGS = False
@@ -56,31 +65,85 @@ _BIN_EXTS = ({'.aif', '.bin', '.bmp', '.cur', '.gif', '.icm', '.ico', '.jpeg',
               '.ttf', '.wav', '.webm', '.webp', '.woff', '.woff2', '.zip'})
 
 class DIRS:
-  # The .git/objects dir containing the original loose objects.
+  # The .git/objects dir containing the original objects (loose or packed).
   ORIGOBJS = None  # Will be figured out at runtime using git --git-dir.
 
-  # Where the new git objects (trees, blobs) will be put.
+  # Where the new git objects (trees, blobs) will be put. With --packs, they
+  # are written as packs in NEWOBJS/pack/ rather than loose objects.
   NEWOBJS = '/mnt/git-objects/'
 
   # Where the binary files (then uploaded to GCS) will be moved.
   GCS = '/mnt/gcs-bucket/'
 
+  # Where the caches and the maps of the rewritten trees and commits are kept,
+  # which allow to resume an interrupted rewrite and to rewrite incrementally.
+  STATE = '/mnt/rewrite-state/'
+
+
+_TREE_CACHE_SLOTS = 1 << 22
+_GCS_BLOBS_SLOTS = 1 << 21
+_LOCAL_CACHE_ENTRIES = 200000
+
+# How often the rewritten objects are made durable and their mapping recorded
+# in DIRS.STATE (see _Checkpoint()). Trees are counted per worker.
+_CHECKPOINT_TREES = 1000
+_CHECKPOINT_COMMITS = 10000
+
+# The commits are rewritten in batches of _COMMIT_BATCH, read and written by
+# the workers in jobs of _COMMIT_JOB_SIZE commits (see _RewriteCommits()).
+_COMMIT_BATCH = 8192
+_COMMIT_JOB_SIZE = 256
 
 # _tree_cache is a map of tree-ish -> translated tree-ish and is used to avoid
-# re-translating sub-trees which are identical between subsequent commits
-_tree_cache = multiprocessing.Manager().dict()
+# re-translating sub-trees which are identical between subsequent commits.
+# It is a SharedHashTable (in DIRS.STATE) shared by all the workers without
+# IPC, fronted by a per-process LRU cache of the hottest entries.
+_tree_cache = None
+_local_tree_cache = LRUCache(_LOCAL_CACHE_ENTRIES, lambda _: 1)
+
+# Set of the SHA1s of the blobs moved into DIRS.GCS (a SharedHashTable with
+# key == value), to copy each of them once and to keep the total count.
+_gcs_blobs = None
+
+# _tree_cache key for the .gitignore built when there is no original one.
+_BLANK_GITIGNORE_KEY = '\xff' * 20
+
+# Where WriteGitObj() puts the new objects: DIRS.NEWOBJS or, with --packs, the
+# PackWriter of the current process (each worker appends to its own pack).
+_new_objs = None
+
+# With --pack-deltas rewritten trees are stored as deltas against the original
+# trees they replace (which MergePacks() then appends to the final packs).
+_pack_deltas = False
+
+# The map file of the current process (DIRS.STATE/tree-map.PID for the tree
+# workers, DIRS.STATE/commit-map for the main process) and the lines
+# ("<orig SHA1> <new SHA1>\n") not yet written into it.
+_map_file = None
+_pending_map_lines = []
 
-# A map of <original tree SHA1 (hex)> -> <translated SHA1> for top-level trees.
-# Contains the results of _TranslateOneTree calls.
-_root_trees = multiprocessing.Manager().dict()
+# With --packs, the map lines which wait for the packs of the other workers
+# (see _Checkpoint()): a list of (set of the tmp pack paths, lines).
+_staged_map_lines = []
 
-# set of SHA1s (just to keep the total count)
-_gcs_blobs = multiprocessing.Manager().dict()
+
+def _GetCachedTranslation(sha1_raw):
+  translation = _local_tree_cache.Get(sha1_raw)
+  if translation is None:
+    translation = _tree_cache.Get(sha1_raw)
+    if translation is not None:
+      _local_tree_cache.Put(sha1_raw, translation)
+  return translation
+
+
+def _CacheTranslation(sha1_raw, translation):
+  _local_tree_cache.Put(sha1_raw, translation)
+  _tree_cache.Put(sha1_raw, translation)
 
 
 def _BuildGitignoreMaybeCached(base_sha1=None):
-  cache_key = base_sha1.raw if base_sha1 else 'blank'
-  cached_gitignore = _tree_cache.get(cache_key)
+  cache_key = base_sha1.raw if base_sha1 else _BLANK_GITIGNORE_KEY
+  cached_gitignore = _GetCachedTranslation(cache_key)
   if cached_gitignore:
     return SHA1(cached_gitignore)
   else:
@@ -88,9 +151,8 @@ def _BuildGitignoreMaybeCached(base_sha1=None):
     if base_sha1:
       gitignore = ReadGitObj(base_sha1, DIRS.ORIGOBJS)[2] + '\n'
     gitignore += '\n'.join(('*' + x for x in sorted(_BIN_EXTS))) + '\n'
-    sha1 = WriteGitObj('blob', gitignore, DIRS.NEWOBJS)
-    collision = _tree_cache.setdefault(cache_key, sha1.raw)
-    assert(collision == sha1.raw)
+    sha1 = WriteGitObj('blob', gitignore, _new_objs)
+    _CacheTranslation(cache_key, sha1.raw)
     return sha1
 
 
@@ -98,13 +160,14 @@ def _MangleTree(root_sha1, in_tests_dir=False, indent=0):
   assert(isinstance(root_sha1, SHA1))
   changed = False
   entries = []
-  cached_translation = _tree_cache.get(root_sha1.raw)
+  cached_translation = _GetCachedTranslation(root_sha1.raw)
   if cached_translation:
     return SHA1(cached_translation)
 
   # if indent == 0: print '\n', root_sha1.hex
   base_gitignore_sha1 = None
-  for mode, fname, sha1 in ReadGitTree(root_sha1, DIRS.ORIGOBJS):
+  orig_tree = ReadGitObj(root_sha1, DIRS.ORIGOBJS)[2]
+  for mode, fname, sha1 in ParseGitTree(orig_tree):
     old_sha1_raw = sha1.raw
     # if indent == 0: print '  ', mode, fname
     if mode[0] == '1':  # It's a file
@@ -115,11 +178,11 @@ def _MangleTree(root_sha1, in_tests_dir=False, indent=0):
           continue  # Will be added below
         elif ext.lower() in _BIN_EXTS:
           csfname = sha1.hex + '.blob'
-          _gcs_blobs[sha1.raw] = 1
-          if not _SKIP_COPY_INTO_CGS:
+          if not _SKIP_COPY_INTO_CGS and _gcs_blobs.Get(sha1.raw) is None:
             CopyGitBlobIntoFile(sha1, DIRS.GCS + csfname, DIRS.ORIGOBJS)
+            _gcs_blobs.Put(sha1.raw, sha1.raw)
           csref = 'src gs://blink-gitcs/' + csfname + '\n'
-          sha1 = WriteGitObj('blob', csref, DIRS.NEWOBJS)
+          sha1 = WriteGitObj('blob', csref, _new_objs)
           fname += '.gitcs'
           changed = True
     else:
@@ -137,42 +200,206 @@ def _MangleTree(root_sha1, in_tests_dir=False, indent=0):
     changed = True
 
   if changed:
-    res = WriteGitTree(entries, DIRS.NEWOBJS)
+    base = (root_sha1, orig_tree) if _pack_deltas else None
+    res = WriteGitTree(entries, _new_objs, base)
   else:
     res =  root_sha1
-  collision = _tree_cache.setdefault(root_sha1.raw, res.raw)
-  assert(collision == res.raw)
+  _CacheTranslation(root_sha1.raw, res.raw)
   return res
 
 
 def _TranslateOneTree(treeish):
+  """Returns (treeish, translated treeish, elapsed time)."""
   try:
-    # Do not bother checking if we already translated the tree. It is extremely
-    # unlikely (i.e. empty commits) and is not worth the overhead of checking.
-    mangled_sha1 = _MangleTree(SHA1.FromHex(treeish))
-    collision = _root_trees.setdefault(treeish, mangled_sha1.hex)
-    assert(collision == mangled_sha1.hex)
+    tstart = time.time()
+    mangled_treeish = _MangleTree(SHA1.FromHex(treeish)).hex
+    _pending_map_lines.append('%s %s\n' % (treeish, mangled_treeish))
+    if len(_pending_map_lines) >= _CHECKPOINT_TREES:
+      with instrument.Phase('rewrite.trees.checkpoint'):
+        _Checkpoint()
+    return treeish, mangled_treeish, time.time() - tstart
   except Exception as e:
     sys.stderr.write('\n' + traceback.format_exc())
     raise
 
 
+def _GetPackDir():
+  return os.path.join(DIRS.NEWOBJS, 'pack')
+
+
+def _InitObjWriter(use_packs):
+  global _new_objs
+  _new_objs = PackWriter(_GetPackDir()) if use_packs else DIRS.NEWOBJS
+
+
+def _InitTreeWorker(use_packs):
+  global _map_file
+  _InitObjWriter(use_packs)
+  _map_file = open(_GetStatePath('tree-map.%d' % os.getpid()), 'a')
+  # Pool workers don't return to the caller, checkpoint on exit.
+  multiprocessing.util.Finalize(None, _Checkpoint, (False,), exitpriority=10)
+  instrument.InitWorker()
+
+
+def _Checkpoint(reopen=True):
+  """Makes the objects written so far durable, then records their mapping.
+
+  Loose objects are durable as soon as written. Packs are finalized and, if
+  reopen, a new one is started. The translations taken from _tree_cache can
+  point to objects in the (tmp) packs of the other workers, though: the map
+  lines are staged until all the packs not finalized at this point are. The
+  ones still staged when the worker exits are resolved by _ResolveStagedMaps().
+  """
+  global _new_objs
+  if isinstance(_new_objs, PackWriter):
+    _new_objs.Close()
+    if _pending_map_lines:
+      _staged_map_lines.append((set(_GetTmpPacks()), _pending_map_lines[:]))
+      del _pending_map_lines[:]
+    _new_objs = PackWriter(_GetPackDir()) if reopen else None
+  for staged in _staged_map_lines[:]:
+    tmp_packs, lines = staged
+    if not any(os.path.exists(path) for path in tmp_packs):
+      _pending_map_lines.extend(lines)
+      _staged_map_lines.remove(staged)
+  if _pending_map_lines:
+    _map_file.write(''.join(_pending_map_lines))
+    _map_file.flush()
+    del _pending_map_lines[:]
+  if _staged_map_lines and not reopen:
+    with open(_GetStatePath('staged-map.%d' % os.getpid()), 'a') as f:
+      for tmp_packs, lines in _staged_map_lines:
+        f.write('packs %s\n' % ' '.join(sorted(tmp_packs)))
+        f.write(''.join(lines))
+    del _staged_map_lines[:]
+
+
+def _GetTmpPacks():
+  return glob.glob(os.path.join(_GetPackDir(), 'tmp-pack-*'))
+
+
+def _ResolveStagedMaps():
+  """Moves the staged map lines whose packs have all been finalized into the
+  tree maps, drops the others (their packs are incomplete)."""
+  for path in glob.glob(_GetStatePath('staged-map.*')):
+    ready = []
+    tmp_packs = None
+    with open(path) as f:
+      for line in f:
+        if line.startswith('packs '):
+          tmp_packs = line.split()[1:]
+        elif not any(os.path.exists(tmp) for tmp in tmp_packs):
+          ready.append(line)
+    pid = path.rsplit('.', 1)[1]
+    with open(_GetStatePath('tree-map.' + pid), 'a') as f:
+      f.write(''.join(ready))
+    os.remove(path)
+
+
+def _GetStatePath(name):
+  return os.path.join(DIRS.STATE, name)
+
+
+def _LoadMap(paths):
+  """Loads the map files written by _Checkpoint() into a dict."""
+  mapping = {}
+  for path in paths:
+    with open(path) as f:
+      for line in f:
+        if len(line) == 82:  # Skip the last line if truncated by a crash.
+          mapping[line[:40]] = line[41:81]
+  return mapping
+
+
+def _LoadTreeMap():
+  """Loads and compacts (into a single file) the tree maps of the workers."""
+  tree_map_path = _GetStatePath('tree-map')
+  paths = glob.glob(tree_map_path + '.*')
+  tree_map = _LoadMap(([tree_map_path] if os.path.exists(tree_map_path) else [])
+                      + paths)
+  if paths:
+    WriteFileAtomic(tree_map_path, ''.join(
+        '%s %s\n' % entry for entry in tree_map.iteritems()))
+    for path in paths:
+      os.remove(path)
+  return tree_map
+
+
+def _OpenCaches():
+  global _tree_cache, _gcs_blobs
+  Makedirs(DIRS.STATE)
+  _tree_cache = SharedHashTable(_GetStatePath('tree-cache'), _TREE_CACHE_SLOTS)
+  _gcs_blobs = SharedHashTable(_GetStatePath('gcs-blobs'), _GCS_BLOBS_SLOTS)
+  _ResolveStagedMaps()  # Before the stale packs, they tell what to drop.
+  stale_packs = _GetTmpPacks()
+  if stale_packs:
+    # A previous run died before finalizing its packs: the objects which the
+    # cached translations point to are gone. The tree and commit maps are
+    # still valid, as their lines are written only after all the packs with
+    # their objects are finalized (see _Checkpoint()).
+    print 'Discarding the tree cache and %d unfinished packs' % len(
+        stale_packs)
+    _tree_cache.Clear()
+    for pack_path in stale_packs:
+      os.remove(pack_path)
+
+
+def _ReadOrigObj(raw_sha):
+  objtype, _, payload = ReadGitObj(SHA1(raw_sha), DIRS.ORIGOBJS)
+  return objtype, payload
+
+
+def _MergePacks():
+  """Merges the packs written since the previous merge."""
+  merged_list_path = _GetStatePath('merged-packs')
+  merged_before = set()
+  if os.path.exists(merged_list_path):
+    merged_before = set(open(merged_list_path).read().split())
+  pack_paths = sorted(
+      path for path in glob.glob(os.path.join(_GetPackDir(), 'pack-*.pack'))
+      if os.path.basename(path) not in merged_before)
+  tstart = time.time()
+  merged_paths = MergePacks(pack_paths, _GetPackDir(), _ReadOrigObj)
+  with open(merged_list_path, 'a') as f:
+    f.write(''.join(os.path.basename(path) + '\n' for path in merged_paths))
+  for pack_path in pack_paths:
+    if pack_path not in merged_paths:
+      os.remove(pack_path[:-5] + '.idx')
+      os.remove(pack_path)
+  print 'Merged %d packs into %d in %s:' % (
+      len(pack_paths), len(merged_paths), _TimeToStr(time.time() - tstart))
+  for pack_path in merged_paths:
+    print '  ' + pack_path
+
+
 def _TimeToStr(seconds):
   tgmt = time.gmtime(seconds)
   return time.strftime('%Hh:%Mm:%Ss', tgmt)
 
 
-def _RewriteTrees(trees):
-  pool = multiprocessing.Pool(int(multiprocessing.cpu_count() * 2))
+def _RewriteTrees(trees, use_packs):
+  """Returns a map of <original tree SHA1 (hex)> -> <translated SHA1>."""
+  num_workers = int(multiprocessing.cpu_count() * 2)
+  pool = multiprocessing.Pool(num_workers, _InitTreeWorker, (use_packs,))
+  root_trees = {}
 
   pending = len(trees)
   done = 0
   tstart = time.time()
   checkpoint_done = 0
   checkpoint_time = tstart
-  for _ in pool.imap_unordered(_TranslateOneTree, trees):
+  busy_secs = 0
+  for treeish, mangled_treeish, tree_secs in pool.imap_unordered(
+      _TranslateOneTree, trees, chunksize=8):
+    root_trees[treeish] = mangled_treeish
     done += 1
     now = time.time()
+    busy_secs += tree_secs
+    instrument.AddPhase('rewrite.trees', tree_secs)
+    instrument.Observe('rewrite.trees.latency', tree_secs)
+    instrument.SetGauge('rewrite.trees.utilization',
+                        busy_secs / num_workers / max(now - tstart, 1e-3))
+    instrument.MaybeReport()
     done_since_checkpoint = done - checkpoint_done
     if done == pending or (done & 63) == 1:
       compl_rate = (now - checkpoint_time) / done_since_checkpoint
@@ -187,55 +414,173 @@ def _RewriteTrees(trees):
 
   pool.close()
   pool.join()
+  _ResolveStagedMaps()
   elapsed = time.time() - tstart
   print '\nTree rewrite completed in %s (%.1f trees/sec)' % (
       _TimeToStr(elapsed), done / elapsed)
   print 'Extracted %d files into %s' % (len(_gcs_blobs), DIRS.GCS)
+  return root_trees
 
 
-def _RewriteCommits(revs):
-  root_trees = _root_trees.copy()  # Un-proxied local copy for faster lookups.
-  total = len(revs)
-  done = 0
-  last_parent = None
-  last_rewritten_parent = None
+def _ReadCommitsJob(revs):
+  """Returns ([payload of each rev], elapsed time)."""
   tstart = time.time()
+  payloads = []
   for rev in revs:
-    objtype, objlen, payload = ReadGitObj(SHA1.FromHex(rev), DIRS.ORIGOBJS)
+    objtype, _, payload = ReadGitObj(SHA1.FromHex(rev), DIRS.ORIGOBJS)
     assert(objtype == 'commit')
-    assert(payload[0:5] == 'tree ')  # A commit obj should begin with a tree ptr
-    orig_tree = payload[5:45]
-    new_tree = root_trees[orig_tree]
-    assert(len(new_tree) == 40)
-    new_payload = 'tree ' + new_tree + '\n'
-    parent = None
-    if not last_parent:
-      assert(payload[46:52] != 'parent')
-      new_payload += payload[46:]
-    else:
-      assert(payload[46:52] == 'parent')
-      parent = payload[53:93]
-      assert(parent == last_parent)
-      new_payload += 'parent ' + last_rewritten_parent + '\n'
-      new_payload += payload[94:]
-
-    last_parent = rev
-    sha1 = WriteGitObj('commit', new_payload, DIRS.NEWOBJS)
-    last_rewritten_parent = sha1.hex
-    done += 1
-    if done % 100 == 1 or done == len(revs):
-      compl_rate = (time.time() - tstart) / done
-      eta = _TimeToStr((total - done) * compl_rate)
-      print '\r%d / %d Commits rewritten (%.1f commits/sec), ETA: %s      ' % (
-          done, total, 1 / compl_rate, eta),
-      sys.stdout.flush()
+    payloads.append(payload)
+  return payloads, time.time() - tstart
 
-  print '\n'
-  print 'Your new head is %s (which corresponds to %s)' % (
-      last_rewritten_parent, last_parent)
+
+def _WriteCommitsJob(args):
+  """Writes the commits as loose objects or, if use_packs, compresses them.
+
+  Returns ([compressed payload] (or None for loose objects), elapsed time).
+  """
+  payloads, use_packs = args
+  tstart = time.time()
+  if use_packs:
+    res = [zlib.compress(payload, 1) for payload in payloads]
+  else:
+    res = None
+    for payload in payloads:
+      WriteGitObj('commit', payload, DIRS.NEWOBJS)
+  return res, time.time() - tstart
+
+
+def _RewriteCommitPayload(payload, tree_map, commit_map):
+  assert(payload[0:5] == 'tree ')  # A commit obj should begin with a tree ptr
+  orig_tree = payload[5:45]
+  new_tree = tree_map[orig_tree]
+  assert(len(new_tree) == 40)
+  new_payload = 'tree ' + new_tree + '\n'
+  # Then one "parent" line per parent (none for root commits, 2+ for merges).
+  pos = 46
+  while payload.startswith('parent ', pos):
+    parent = payload[pos + 7:pos + 47]
+    new_payload += 'parent ' + commit_map[parent] + '\n'
+    pos += 48
+  return new_payload + payload[pos:]
+
+
+def _SplitList(items, size):
+  return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def _RewriteCommits(revs, tree_map, commit_map, use_packs):
+  """Rewrites revs (parents first), adding them to commit_map.
+
+  Only rewriting the commits and computing their SHA1 (each depends on the
+  ones of the parents) is sequential. It is pipelined, in batches, with the
+  parallel reading (+ decompression) of the next batch and the compression
+  (+ writing) of the previous one.
+  """
+  num_workers = multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(num_workers, instrument.InitWorker)
+  total = len(revs)
+  stages = ('read', 'hash', 'write')
+  stage_times = dict.fromkeys(stages, 0.0)  # Stage -> busy seconds.
+  stage_done = dict.fromkeys(stages, 0)  # Stage -> commits processed.
+  tstart = time.time()
+
+  def _FormatRates():
+    # The throughput of each stage if it was the only one running.
+    return ', '.join('%s: %.0f/s' % (
+        stage, stage_done[stage] / max(stage_times[stage], 1e-6))
+        for stage in stages)
+
+  def _Collect(stage, async_result, num_commits):
+    results = []
+    for chunk_result, elapsed in async_result.get():
+      results += chunk_result or []
+      # The jobs of a stage run on all the workers in parallel.
+      stage_times[stage] += elapsed / num_workers
+      instrument.AddPhase('rewrite.commits.' + stage, elapsed, 0)
+    instrument.AddPhase('rewrite.commits.' + stage, 0, num_commits)
+    stage_done[stage] += num_commits
+    # The fraction of the time the workers have been busy (reading + writing).
+    instrument.SetGauge('rewrite.commits.utilization',
+                        (stage_times['read'] + stage_times['write']) /
+                        max(time.time() - tstart, 1e-3))
+    return results
+
+  def _FinishWrite(batch, shas, new_payloads, async_result):
+    compressed_payloads = _Collect('write', async_result, len(batch))
+    for i, rev in enumerate(batch):
+      if use_packs:
+        _new_objs.AddRaw(shas[i], OBJ_COMMIT, len(new_payloads[i]),
+                         compressed_payloads[i])
+      _pending_map_lines.append('%s %s\n' % (rev, commit_map[rev]))
+    if len(_pending_map_lines) >= _CHECKPOINT_COMMITS:
+      _Checkpoint()
+
+  batches = _SplitList(revs, _COMMIT_BATCH)
+  reads = pool.map_async(_ReadCommitsJob,
+                         _SplitList(batches[0], _COMMIT_JOB_SIZE))
+  pending_write = None
+  for i, batch in enumerate(batches):
+    payloads = _Collect('read', reads, len(batch))
+    if i + 1 < len(batches):  # Prefetch the next batch.
+      reads = pool.map_async(_ReadCommitsJob,
+                             _SplitList(batches[i + 1], _COMMIT_JOB_SIZE))
+
+    hash_start = time.time()
+    shas = []
+    new_payloads = []
+    for rev, payload in zip(batch, payloads):
+      new_payload = _RewriteCommitPayload(payload, tree_map, commit_map)
+      hasher = hashlib.sha1('commit %d\x00' % len(new_payload))
+      hasher.update(new_payload)
+      shas.append(hasher.digest())
+      new_payloads.append(new_payload)
+      commit_map[rev] = SHA1.RawToHex(shas[-1])
+    hash_secs = time.time() - hash_start
+    stage_times['hash'] += hash_secs
+    stage_done['hash'] += len(batch)
+    instrument.AddPhase('rewrite.commits.hash', hash_secs, len(batch))
+    instrument.Observe('rewrite.commits.hash.latency', hash_secs / len(batch))
+
+    if pending_write:
+      _FinishWrite(*pending_write)
+    pending_write = (batch, shas, new_payloads, pool.map_async(
+        _WriteCommitsJob, [(chunk, use_packs) for chunk in
+                           _SplitList(new_payloads, _COMMIT_JOB_SIZE)]))
+
+    done = stage_done['hash']
+    compl_rate = (time.time() - tstart) / done
+    eta = _TimeToStr((total - done) * compl_rate)
+    print '\r%d / %d Commits rewritten (%.1f commits/sec; %s), ETA: %s  ' % (
+        done, total, 1 / compl_rate, _FormatRates(), eta),
+    sys.stdout.flush()
+    instrument.MaybeReport()
+
+  _FinishWrite(*pending_write)
+  pool.close()
+  pool.join()
+  _Checkpoint(reopen=False)
+  elapsed = time.time() - tstart
+  print '\nCommit rewrite completed in %s (%.1f commits/sec; %s)\n' % (
+      _TimeToStr(elapsed), total / elapsed, _FormatRates())
 
 
 def main():
+  global _pack_deltas, _map_file
+  parser = optparse.OptionParser(usage='%prog [options] [rev-list-file]')
+  parser.add_option('--branch', default='master',
+                    help='The branch to rewrite (default: %default)')
+  parser.add_option('--from-scratch', action='store_true', default=False,
+                    help='Forget the trees and commits rewritten by the '
+                         'previous runs (see DIRS.STATE)')
+  parser.add_option('--packs', action='store_true', default=False,
+                    help='Write the new objects as packs, not loose objects')
+  parser.add_option('--pack-deltas', action='store_true', default=False,
+                    help='Delta the rewritten trees against the original ones '
+                         '(implies --packs)')
+  options, args = parser.parse_args()
+  use_packs = options.packs or options.pack_deltas
+  _pack_deltas = options.pack_deltas
+
   print 'New git objects:', DIRS.NEWOBJS
   Makedirs(DIRS.NEWOBJS)
 
@@ -248,15 +593,34 @@ def main():
   else:
     print 'WARNING: Omitting GCS object generation.'
 
+  # The state persists: a new run resumes from (or, once completed, catches up
+  # incrementally with) the trees and commits rewritten so far.
+  print 'Rewrite state:', DIRS.STATE
+  if options.from_scratch:
+    for path in glob.glob(_GetStatePath('*')):
+      os.remove(path)
+  _OpenCaches()
+  tree_map = _LoadTreeMap()
+  commit_map = _LoadMap(glob.glob(_GetStatePath('commit-map')))
+  print 'Rewritten so far: %d commits, %d trees' % (len(commit_map),
+                                                    len(tree_map))
+
   print ''
   revs = []
   trees = []
 
-  if len(sys.argv) > 1:
-    print 'Reading cached rev-list + trees from ' + sys.argv[1]
-    reader = open(sys.argv[1])
+  if args:
+    print 'Reading cached rev-list + trees from ' + args[0]
+    reader = open(args[0])
   else:
-    cmd = ['git', 'rev-list', '--format=%T', '--reverse', 'master']
+    # Parents come before their children, merges included.
+    cmd = ['git', 'rev-list', '--format=%T', '--reverse', '--topo-order',
+           options.branch]
+    head_path = _GetStatePath('head')
+    if os.path.exists(head_path):
+      prev_head = open(head_path).read().strip()
+      if prev_head in commit_map:
+        cmd.append('^' + prev_head)
     print 'Running [%s], might take a while' % ' '.join(cmd)
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1048576)
     reader = proc.stdout
@@ -265,30 +629,47 @@ def main():
   # commit abcdef1234 <- commit-ish (irrelevant for us here)
   # 567890abcdef      <- tree-ish
   # commit ....
+  # Commits already rewritten by a previous run are skipped.
+  head = None
   while True:
     line = reader.readline()
     if not line:
       break
     line = line.rstrip('\r\n')
     if line.startswith('commit'):
-      rev = line[7:]
-      assert(len(rev) == 40)
-      revs.append(rev)
+      head = line[7:]
+      assert(len(head) == 40)
+      already_rewritten = head in commit_map
+      if not already_rewritten:
+        revs.append(head)
       continue
     else:
       assert(len(line) == 40)
-      trees.append(line)
+      if not already_rewritten:
+        trees.append(line)
 
-  assert(len(revs) == len(trees))
   print 'Got %d revisions to rewrite' % len(revs)
+  if not revs:
+    return 0
+  trees = [tree for tree in collections.OrderedDict.fromkeys(trees)
+           if tree not in tree_map]
 
-
-  print '\nStep 1: Rewriting trees in parallel'
-  _RewriteTrees(trees)
+  print '\nStep 1: Rewriting %d trees in parallel' % len(trees)
+  tree_map.update(_RewriteTrees(trees, use_packs))
 
   print '\nStep 2: Rewriting commits serially'
-  _RewriteCommits(revs)
+  _InitObjWriter(use_packs)
+  _map_file = open(_GetStatePath('commit-map'), 'a')
+  _RewriteCommits(revs, tree_map, commit_map, use_packs)
+  if not args:
+    WriteFileAtomic(_GetStatePath('head'), head + '\n')
 
+  if use_packs:
+    print '\nStep 3: Merging the packs'
+    _MergePacks()
+
+  print 'Your new head is %s (which corresponds to %s)' % (
+      commit_map[head], head)
   print 'You should now run git fsck NEW_HEAD_SHA. You are a fool if you don\'t'
 
 
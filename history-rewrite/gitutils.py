@@ -24,24 +24,42 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
-A set of helper functions to read / write Git loose objects.
+A set of helper functions to read / write Git loose objects and pack files.
 """
 
+import array
+import bisect
+import collections
+import errno
+import glob
 import hashlib
+import mmap
 import os
+import re
+import struct
 import subprocess
+import sys
 import zlib
 
 
-class SHA1:
+class SHA1(object):
+  __slots__ = ('raw', '_hex')
+
   def __init__(self, value, hexvalue=None):
     assert len(value) == 20
     self.raw = value
-    self.hex = value.encode('hex') if hexvalue is None else hexvalue
-    assert len(self.hex) == 40
+    self._hex = hexvalue
+
+  @property
+  def hex(self):
+    # Computed lazily: most SHA1s (e.g., tree entries) are never printed.
+    if self._hex is None:
+      self._hex = self.raw.encode('hex')
+    return self._hex
 
   @staticmethod
   def FromHex(hexvalue):
+    assert len(hexvalue) == 40
     return SHA1(hexvalue.decode('hex'), hexvalue)
 
   @staticmethod
@@ -67,7 +85,14 @@ def WriteFileAtomic(file_path, data):
   os.rename(tmp_path, file_path)
 
 
-def WriteGitObj(objtype, payload, objdir):
+def WriteGitObj(objtype, payload, objdir, base=None):
+  """Writes a loose object into objdir, or appends it to objdir if a PackWriter.
+
+  base is an optional (SHA1, payload) of a similar object, used (only by
+  PackWriter) as a delta base.
+  """
+  if isinstance(objdir, PackWriter):
+    return objdir.Add(objtype, payload, base)
   data = ('%s %d\x00' % (objtype, len(payload))) + payload
   hasher = hashlib.sha1()
   hasher.update(data)
@@ -82,8 +107,15 @@ def WriteGitObj(objtype, payload, objdir):
 
 
 def ReadGitObj(sha1, objdir):
+  """Returns (objtype, objlen, payload), reading loose objects or packs."""
   assert(isinstance(sha1, SHA1))
-  objpath = os.path.join(objdir, sha1.hex[0:2], sha1.hex[2:])
+  reader = _obj_readers.get(objdir)
+  if reader is None:
+    reader = _obj_readers[objdir] = ObjectReader(objdir)
+  return reader.Read(sha1)
+
+
+def _ReadLooseGitObj(objpath):
   with open(objpath, 'rb') as fin:
     data = zlib.decompress(fin.read())
   headlen = data.index('\x00')
@@ -106,33 +138,902 @@ def ReadGitTree(sha1, objdir):
   objtype, _, data = ReadGitObj(sha1, objdir)
   #print 'READING ', sha1.hex, objtype
   assert(objtype == 'tree')
-  s = 0
-  entries = []
-  while s < len(data):
-    s1 = data.find(' ', s)
-    s2 = data.find('\0', s)
-    mode = data[s:s1]
-    fname = data[(s1+1):s2]
-    sha1 = SHA1(data[(s2+1):(s2+21)])
-    s = s2 + 21
-    entries.append((mode, fname, sha1))
-  return entries
+  return ParseGitTree(data)
+
+
+# A tree is a sequence of "<mode> <fname>\0<raw sha1>" entries.
+_TREE_ENTRY_RE = re.compile(r'(\d+) ([^\x00]*)\x00(.{20})', re.DOTALL)
+_TREE_FNAME_SHA_RE = re.compile(r'\d+ ([^\x00]*)\x00(.{20})', re.DOTALL)
+
 
+def ParseGitTree(data):
+  """Like ReadGitTree(), for the payload of a tree object."""
+  return [(mode, fname, SHA1(sha)) for mode, fname, sha in
+          _TREE_ENTRY_RE.findall(data)]
 
-def _GitTreeEntryGetSortKey(entry):
-  if entry[0][-5:-3] == '40':  # mode starts with 04 -> entry is a subtree.
-    return entry[1] + '/'  # Awkward Git sorting legacy bug. See goo.gl/Xfh0BX.
-  else:
-    return entry[1]
 
+def ParseGitTreeRaw(data):
+  """Like ParseGitTree(), but returns the (raw) SHA-1s as str."""
+  return _TREE_ENTRY_RE.findall(data)
 
-def WriteGitTree(entries, objdir):
-  payload = ''
-  for e in sorted(entries, key=_GitTreeEntryGetSortKey):
-    payload += e[0] + ' ' + e[1] + '\x00' + e[2].raw
-  return WriteGitObj('tree', payload, objdir)
+
+def ParseGitTreeToDict(data):
+  """Returns a dict {fname: raw_sha1} with the entries of a tree payload."""
+  return dict(_TREE_FNAME_SHA_RE.findall(data))
+
+
+def EncodeGitTree(entries):
+  """Returns the payload of a tree made of (mode, fname, sha1) entries.
+
+  The entries are sorted in git order, unless they are sorted already (e.g.,
+  as returned by ParseGitTree()).
+  """
+  # mode starts with 04 -> entry is a subtree, sorted as if its name ended with
+  # '/'. Awkward Git sorting legacy bug. See goo.gl/Xfh0BX.
+  keys = [fname + '/' if mode[-5:-3] == '40' else fname
+          for mode, fname, _ in entries]
+  if keys != sorted(keys):
+    entries = [entries[i] for i in
+               sorted(xrange(len(keys)), key=keys.__getitem__)]
+  return ''.join([mode + ' ' + fname + '\x00' + sha1.raw
+                  for mode, fname, sha1 in entries])
+
+
+def WriteGitTree(entries, objdir, base=None):
+  return WriteGitObj('tree', EncodeGitTree(entries), objdir, base)
 
 
 def GetCurGitDir():
   return subprocess.check_output(
       ['git', 'rev-parse', '--git-dir']).strip('\r\n')
+
+
+class LRUCache(object):
+  """A dict-like cache bounded by the total size (as per sizeof) of its values.
+
+  The least recently used entries are evicted first. Values bigger than
+  max_size / 4 are not cached at all, so that a single huge object cannot
+  flush the whole cache.
+  """
+  def __init__(self, max_size, sizeof=len):
+    self.max_size = max_size
+    self.size = 0
+    self._sizeof = sizeof
+    self._entries = collections.OrderedDict()  # key -> (value, size).
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def Get(self, key, default=None):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return default
+    self._entries[key] = entry  # Move to the MRU end.
+    return entry[0]
+
+  def Put(self, key, value):
+    size = self._sizeof(value)
+    if size > self.max_size / 4:
+      return
+    old_entry = self._entries.pop(key, None)
+    if old_entry:
+      self.size -= old_entry[1]
+    self._entries[key] = (value, size)
+    self.size += size
+    while self.size > self.max_size:
+      _, (_, evicted_size) = self._entries.popitem(last=False)
+      self.size -= evicted_size
+
+
+class SharedHashTable(object):
+  """A lossy map of SHA-1 -> SHA-1, in a file mmap-ed by all the processes.
+
+  The table is meant to be opened before forking worker processes, which then
+  read and write it concurrently without locks (nor IPC), and persists across
+  runs. Each key hashes to a bucket of _WAYS slots. When a bucket is full, one
+  of its entries is overwritten: the table is a cache, lookups can miss.
+  Each slot carries a checksum of its key and value, so that slots torn by
+  concurrent writes (or by a crash) are detected and ignored.
+  A SHA-1 of all zeros cannot be used as a key (it marks empty slots).
+  """
+  _WAYS = 4
+  _SLOT_SIZE = 48  # key (20), value (20), checksum (8).
+
+  def __init__(self, path, num_slots):
+    self.path = path
+    num_slots -= num_slots % self._WAYS
+    self._num_buckets = num_slots / self._WAYS
+    size = num_slots * self._SLOT_SIZE
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+      if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, 0)  # Different geometry, start from scratch.
+        os.ftruncate(fd, size)
+      self._mm = mmap.mmap(fd, size, mmap.MAP_SHARED)
+    finally:
+      os.close(fd)
+
+  @staticmethod
+  def _Checksum(key_value):
+    return struct.pack('>ii', zlib.crc32(key_value), zlib.adler32(key_value))
+
+  def _GetBucketStart(self, key):
+    bucket = struct.unpack_from('>I', key)[0] % self._num_buckets
+    return bucket * self._WAYS * self._SLOT_SIZE
+
+  def Get(self, key, default=None):
+    start = self._GetBucketStart(key)
+    for pos in xrange(start, start + self._WAYS * self._SLOT_SIZE,
+                      self._SLOT_SIZE):
+      slot = self._mm[pos:pos + self._SLOT_SIZE]
+      if slot[:20] == key and self._Checksum(slot[:40]) == slot[40:]:
+        return slot[20:40]
+    return default
+
+  def Put(self, key, value):
+    assert(len(key) == 20 and len(value) == 20)
+    start = self._GetBucketStart(key)
+    victim = None
+    for pos in xrange(start, start + self._WAYS * self._SLOT_SIZE,
+                      self._SLOT_SIZE):
+      slot_key = self._mm[pos:pos + 20]
+      if slot_key == key or slot_key == '\x00' * 20:
+        victim = pos
+        break
+    if victim is None:
+      victim = start + (ord(key[4]) % self._WAYS) * self._SLOT_SIZE
+    self._mm[victim:victim + self._SLOT_SIZE] = (
+        key + value + self._Checksum(key + value))
+
+  def __len__(self):
+    """Returns the number of (valid) entries. Scans the whole table."""
+    count = 0
+    empty_key = '\x00' * 20
+    for pos in xrange(0, len(self._mm), self._SLOT_SIZE):
+      slot = self._mm[pos:pos + self._SLOT_SIZE]
+      if slot[:20] != empty_key and self._Checksum(slot[:40]) == slot[40:]:
+        count += 1
+    return count
+
+  def Clear(self):
+    self._mm.seek(0)
+    zeros = '\x00' * 1048576
+    while self._mm.tell() < len(self._mm):
+      self._mm.write(zeros[:len(self._mm) - self._mm.tell()])
+
+  def Close(self):
+    self._mm.close()
+
+
+# Object types, as encoded in pack files.
+OBJ_COMMIT, OBJ_TREE, OBJ_BLOB, OBJ_TAG, OBJ_OFS_DELTA, OBJ_REF_DELTA = (
+    1, 2, 3, 4, 6, 7)
+OBJ_TYPE_NAMES = {OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob',
+                  OBJ_TAG: 'tag'}
+_PACK_OBJ_TYPES = dict((name, t) for t, name in OBJ_TYPE_NAMES.iteritems())
+
+
+class PackError(Exception):
+  """Raised for objects which cannot be read (missing bases, truncation)."""
+  pass
+
+
+class PackIndex(object):
+  """A .idx file (version 1 or 2), memory-mapped.
+
+  The fanout and SHA-1 tables are accessed in place. Only the offsets are
+  copied, in an array, to be able to iterate the objects in pack order.
+  """
+  def __init__(self, idx_path):
+    with open(idx_path, 'rb') as fd:
+      self._mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    if self._mm[0:4] == '\377tOc':
+      self.version = struct.unpack_from('>I', self._mm, 4)[0]
+      assert(self.version == 2)
+      self._fanout_start = 8
+    else:
+      self.version = 1
+      self._fanout_start = 0
+    tables_start = self._fanout_start + 1024  # After the 256 fanout entries.
+    self.count = struct.unpack_from('>I', self._mm, tables_start - 4)[0]
+    if self.version == 1:
+      self._sha_start = tables_start + 4
+      self._sha_stride = 24
+      self.offsets = array.array('I', (
+          struct.unpack_from('>I', self._mm, tables_start + 24 * i)[0]
+          for i in xrange(self.count)))
+      return
+
+    self._sha_start = tables_start
+    self._sha_stride = 20
+    offsets_start = tables_start + self.count * 24  # SHA-1s + CRC32s.
+    self.offsets = array.array('I')
+    self.offsets.fromstring(self._mm[offsets_start:
+                                     offsets_start + self.count * 4])
+    if sys.byteorder == 'little':
+      self.offsets.byteswap()
+    large_offsets_start = offsets_start + self.count * 4
+    if any(off & 0x80000000 for off in self.offsets):
+      # Packs > 2 GB: the MSB flags an index into the 64-bit offsets table.
+      self.offsets = array.array('L', (
+          off if not off & 0x80000000 else struct.unpack_from(
+              '>Q', self._mm, large_offsets_start + 8 * (off & 0x7fffffff))[0]
+          for off in self.offsets))
+
+  def GetSHA1(self, i):
+    """Returns the (raw) SHA-1 of the i-th object, in SHA-1 order."""
+    start = self._sha_start + i * self._sha_stride
+    return self._mm[start:start + 20]
+
+  def Find(self, sha):
+    """Returns the pack offset of the object with the (raw) SHA-1 or None."""
+    first_byte = ord(sha[0])
+    lo = 0
+    if first_byte > 0:
+      lo = struct.unpack_from('>I', self._mm,
+                              self._fanout_start + 4 * (first_byte - 1))[0]
+    hi = struct.unpack_from('>I', self._mm,
+                            self._fanout_start + 4 * first_byte)[0]
+    while lo < hi:
+      mid = (lo + hi) / 2
+      mid_sha = self.GetSHA1(mid)
+      if mid_sha < sha:
+        lo = mid + 1
+      elif mid_sha > sha:
+        hi = mid
+      else:
+        return self.offsets[mid]
+    return None
+
+  def Close(self):
+    self._mm.close()
+
+
+class PackFile(object):
+  """A memory-mapped .pack file, together with its .idx.
+
+  Deltas (both OFS_DELTA and REF_DELTA) are resolved by walking their chain
+  iteratively (chains can be deeper than Python's recursion limit). The resolved
+  objects are kept in a LRUCache of base_cache_size bytes, which works best
+  when objects are read in pack order (as IterObjects() does), as git places
+  delta bases before their deltas. REF_DELTA bases which are not in this pack
+  are looked up in |db| (a PackDB), if given, e.g., for thin packs.
+  The compressed size of each object is inferred from the offset of the next
+  object in the pack, so truncated (i.e. incomplete) packs are tolerated:
+  reading an object which is missing or depends on a missing base raises a
+  PackError, but doesn't prevent reading the rest of the pack.
+  """
+  def __init__(self, pack_path, db=None, base_cache_size=64 * 1048576):
+    self.path = pack_path
+    self.idx = PackIndex(pack_path[:-5] + '.idx')
+    self.db = db
+    with open(pack_path, 'rb') as fd:
+      self._mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    if self._mm[0:4] != 'PACK':
+      raise PackError('%s: not a pack file' % pack_path)
+    self._sorted_offsets = array.array(self.idx.offsets.typecode,
+                                       sorted(self.idx.offsets))
+    # The last 20 bytes are the pack checksum, unless the pack is truncated.
+    self._data_end = len(self._mm) - 20
+    self._base_cache = LRUCache(base_cache_size, lambda obj: len(obj[1]))
+    self._types = {}  # offset -> resolved object type (see _GetType()).
+    self._order = None  # Index (SHA-1 order) of the objects in pack order.
+    self._depths = {}  # offset -> delta chain depth (see GetPackedInfo()).
+
+  def __len__(self):
+    return self.idx.count
+
+  def GetChecksum(self):
+    """Returns the (hex) SHA-1 trailer of the pack."""
+    return SHA1.RawToHex(self._mm[-20:])
+
+  def _GetEnd(self, offset):
+    """Returns the offset where the (compressed) object at offset ends."""
+    i = bisect.bisect_right(self._sorted_offsets, offset)
+    if i < len(self._sorted_offsets):
+      return min(self._sorted_offsets[i], len(self._mm))
+    return max(self._data_end, offset)
+
+  def _ReadHeader(self, offset):
+    """Returns (type, size, base, data_offset) for the object at offset.
+
+    base is the offset of the delta base for OFS_DELTA, its raw SHA-1 for
+    REF_DELTA, None otherwise. size is the size of the (delta) data.
+    """
+    if offset >= len(self._mm):
+      raise PackError('Object @ %d is beyond the end of the pack' % offset)
+    hdr = bytearray(self._mm[offset:offset + 32])
+    c = hdr[0]
+    objtype = (c >> 4) & 7
+    size = c & 15
+    shift = 4
+    pos = 1
+    while c & 0x80:
+      c = hdr[pos]
+      pos += 1
+      size |= (c & 0x7f) << shift
+      shift += 7
+    base = None
+    if objtype == OBJ_OFS_DELTA:
+      c = hdr[pos]
+      pos += 1
+      rel_offset = c & 0x7f
+      while c & 0x80:
+        c = hdr[pos]
+        pos += 1
+        rel_offset = ((rel_offset + 1) << 7) | (c & 0x7f)
+      base = offset - rel_offset
+    elif objtype == OBJ_REF_DELTA:
+      base = str(hdr[pos:pos + 20])
+      pos += 20
+    return objtype, size, base, offset + pos
+
+  def _Inflate(self, data_offset, size, max_size=None):
+    end = self._GetEnd(data_offset)
+    try:
+      data = zlib.decompressobj().decompress(
+          self._mm[data_offset:end], max_size or size)
+    except zlib.error as e:
+      raise PackError('Corrupted object @ %d (%s)' % (data_offset, e))
+    if len(data) != min(size, max_size or size):
+      raise PackError('Truncated object @ %d' % data_offset)
+    return data
+
+  def _FindBase(self, base):
+    """Returns (pack, offset) for a delta base or raises PackError."""
+    if not isinstance(base, str):
+      return self, base
+    offset = self.idx.Find(base)
+    if offset is not None:
+      return self, offset
+    pack_and_offset = self.db.Find(base) if self.db else None
+    if not pack_and_offset:
+      raise PackError('Missing delta base %s' % SHA1.RawToHex(base))
+    return pack_and_offset
+
+  def _GetType(self, offset):
+    """Returns the type of the object at offset, following the delta chain."""
+    chain = []  # The (pack, offset) of the deltas whose type is not known.
+    pack = self
+    objtype = pack._types.get(offset)
+    while objtype is None:
+      objtype, _, base, _ = pack._ReadHeader(offset)
+      if base is None:
+        break
+      chain.append((pack, offset))
+      pack, offset = pack._FindBase(base)
+      objtype = pack._types.get(offset)
+    pack._types[offset] = objtype
+    for pack, offset in chain:
+      pack._types[offset] = objtype
+    return objtype
+
+  def _GetOrder(self):
+    if self._order is None:
+      self._order = array.array('I', sorted(
+          xrange(self.idx.count), key=self.idx.offsets.__getitem__))
+    return self._order
+
+  def GetSHA1AtOffset(self, offset):
+    """Returns the raw SHA-1 of the object at offset."""
+    i = bisect.bisect_left(self._sorted_offsets, offset)
+    if i == len(self._sorted_offsets) or self._sorted_offsets[i] != offset:
+      raise PackError('No object @ %d' % offset)
+    return self.idx.GetSHA1(self._GetOrder()[i])
+
+  def _GetDepth(self, offset):
+    chain = []  # The (pack, offset) of the deltas leading to (pack, offset).
+    pack = self
+    depth = pack._depths.get(offset)
+    while depth is None:
+      _, _, base, _ = pack._ReadHeader(offset)
+      if base is None:
+        depth = 0
+        break
+      try:
+        base_pack, base_offset = pack._FindBase(base)
+      except PackError:
+        depth = 1  # Only the link to the missing base is known.
+        break
+      chain.append((pack, offset))
+      pack, offset = base_pack, base_offset
+      depth = pack._depths.get(offset)
+    pack._depths[offset] = depth
+    for pack, offset in reversed(chain):
+      depth += 1
+      pack._depths[offset] = depth
+    return depth
+
+  def GetPackedInfo(self, offset):
+    """Returns (packed_size, base_sha, depth, external) for an object.
+
+    packed_size is the number of bytes taken by the object in the pack (header
+    included). For deltas, base_sha is the raw SHA-1 of the delta base, depth
+    is the length of the delta chain (0 for undeltified objects) and external
+    is True if the base is not in this pack (thin packs, missing bases).
+    """
+    _, _, base, _ = self._ReadHeader(offset)
+    base_sha = None
+    external = False
+    if isinstance(base, str):
+      base_sha = base
+      external = self.idx.Find(base) is None
+    elif base is not None:
+      base_sha = self.GetSHA1AtOffset(base)
+    return (self._GetEnd(offset) - offset, base_sha, self._GetDepth(offset),
+            external)
+
+  def ReadInfo(self, offset):
+    """Returns the type name and the (undeltified) size of an object."""
+    objtype, size, base, data_offset = self._ReadHeader(offset)
+    if base is not None:
+      # The delta data starts with the (varint) sizes of the base and target.
+      delta_hdr = bytearray(self._Inflate(data_offset, size, 32))
+      _, pos = _ReadDeltaVarint(delta_hdr, 0)
+      size, _ = _ReadDeltaVarint(delta_hdr, pos)
+    return OBJ_TYPE_NAMES.get(self._GetType(offset)), size
+
+  def ReadRaw(self, offset):
+    """Returns (type, size, base, compressed_data) of the object at offset.
+
+    Unlike Read(), deltas are not resolved: type is the pack type (e.g.
+    OBJ_REF_DELTA) and base as in _ReadHeader().
+    """
+    objtype, size, base, data_offset = self._ReadHeader(offset)
+    return objtype, size, base, self._mm[data_offset:self._GetEnd(offset)]
+
+  def Read(self, offset, max_size=None):
+    """Returns (type_name, data) of the object at offset.
+
+    If max_size is given, data can be truncated to max_size (which is cheap
+    only for non-deltified objects). Raises PackError if the object cannot be
+    read because of missing bases or truncation.
+    """
+    obj = self._base_cache.Get(offset)
+    if obj is None:
+      # Walk down the chain to a cached or undeltified object, then apply the
+      # deltas back up.
+      chain = []  # The (pack, offset, size, data_offset) of the deltas.
+      pack = self
+      while True:
+        objtype, size, base, data_offset = pack._ReadHeader(offset)
+        if base is None:
+          data = pack._Inflate(data_offset, size, None if chain else max_size)
+          if len(data) < size:
+            return OBJ_TYPE_NAMES.get(objtype), data  # Partial: not cached.
+          obj = (OBJ_TYPE_NAMES.get(objtype), data)
+          pack._types[offset] = objtype
+          pack._base_cache.Put(offset, obj)
+          break
+        chain.append((pack, offset, size, data_offset))
+        pack, offset = pack._FindBase(base)
+        obj = pack._base_cache.Get(offset)
+        if obj is not None:
+          objtype = pack._GetType(offset)
+          break
+      for pack, offset, size, data_offset in reversed(chain):
+        obj = (obj[0], ApplyDelta(obj[1], pack._Inflate(data_offset, size)))
+        pack._types[offset] = objtype
+        pack._base_cache.Put(offset, obj)
+    return obj if not max_size else (obj[0], obj[1][:max_size])
+
+  def IterObjects(self, start=0, end=None):
+    """Yields (sha, type_name, size, offset) for each object, in pack order.
+
+    start and end allow to iterate only over a range of the objects, e.g., to
+    split the work across processes. type_name is None for objects which
+    cannot be read (see PackError).
+    """
+    for i in self._GetOrder()[start:end]:
+      offset = self.idx.offsets[i]
+      try:
+        type_name, size = self.ReadInfo(offset)
+      except PackError:
+        type_name, size = None, 0
+      yield self.idx.GetSHA1(i), type_name, size, offset
+
+  def Close(self):
+    self._mm.close()
+    self.idx.Close()
+
+
+class ObjectReader(object):
+  """Reads the objects of an objects/ dir, loose or in packs (objects/pack).
+
+  The packs are opened (memory-mapped) on the first object which is not found
+  loose. Trees are kept in a LRUCache of cache_size bytes, as the same (sub)
+  trees tend to be read over and over when walking many revisions.
+  """
+  def __init__(self, objdir, cache_size=64 * 1048576):
+    self.objdir = objdir
+    self._db = None
+    self._tree_cache = LRUCache(cache_size, lambda obj: obj[1])
+
+  def Read(self, sha1):
+    obj = self._tree_cache.Get(sha1.raw)
+    if obj:
+      return obj
+    try:
+      obj = _ReadLooseGitObj(
+          os.path.join(self.objdir, sha1.hex[0:2], sha1.hex[2:]))
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      obj = self._ReadPacked(sha1)
+    if obj[0] == 'tree':
+      self._tree_cache.Put(sha1.raw, obj)
+    return obj
+
+  def _ReadPacked(self, sha1):
+    if self._db is None:
+      self._db = PackDB(os.path.join(self.objdir, 'pack'))
+    pack_and_offset = self._db.Find(sha1.raw)
+    if not pack_and_offset:
+      raise IOError(errno.ENOENT, 'Object not found', sha1.hex)
+    objtype, payload = pack_and_offset[0].Read(pack_and_offset[1])
+    return objtype, len(payload), payload
+
+  def Close(self):
+    if self._db:
+      self._db.Close()
+
+
+# objdir -> ObjectReader, for ReadGitObj().
+_obj_readers = {}
+
+
+class PackDB(object):
+  """All the .pack files in a directory (or just the given pack_paths)."""
+  def __init__(self, pack_dir, base_cache_size=64 * 1048576, pack_paths=None):
+    if pack_paths is None:
+      pack_paths = sorted(glob.glob(os.path.join(pack_dir, '*.pack')))
+    self.packs = [PackFile(path, self, base_cache_size) for path in pack_paths
+                  if os.path.exists(path[:-5] + '.idx')]
+
+  def Find(self, sha):
+    """Returns (pack, offset) for the object with the raw SHA-1 or None."""
+    for pack in self.packs:
+      offset = pack.idx.Find(sha)
+      if offset is not None:
+        return pack, offset
+    return None
+
+  def IterObjects(self):
+    """Yields (sha, type_name, size, pack, offset). See PackFile.IterObjects"""
+    for pack in self.packs:
+      for sha, type_name, size, offset in pack.IterObjects():
+        yield sha, type_name, size, pack, offset
+
+  def Close(self):
+    for pack in self.packs:
+      pack.Close()
+
+
+def _ReadDeltaVarint(data, pos):
+  value = 0
+  shift = 0
+  while True:
+    c = data[pos]
+    pos += 1
+    value |= (c & 0x7f) << shift
+    shift += 7
+    if not c & 0x80:
+      return value, pos
+
+
+def ApplyDelta(base, delta):
+  """Reconstructs an object from its base and a git (pack) delta."""
+  delta_bytes = bytearray(delta)
+  base_size, pos = _ReadDeltaVarint(delta_bytes, 0)
+  target_size, pos = _ReadDeltaVarint(delta_bytes, pos)
+  if base_size != len(base):
+    raise PackError('Delta base size mismatch')
+  chunks = []
+  delta_len = len(delta_bytes)
+  while pos < delta_len:
+    cmd = delta_bytes[pos]
+    pos += 1
+    if cmd & 0x80:  # Copy from base.
+      copy_offset = 0
+      for i in xrange(4):
+        if cmd & (1 << i):
+          copy_offset |= delta_bytes[pos] << (8 * i)
+          pos += 1
+      copy_size = 0
+      for i in xrange(3):
+        if cmd & (0x10 << i):
+          copy_size |= delta_bytes[pos] << (8 * i)
+          pos += 1
+      copy_size = copy_size or 0x10000
+      chunks.append(base[copy_offset:copy_offset + copy_size])
+    elif cmd:  # Insert literal data.
+      chunks.append(delta[pos:pos + cmd])
+      pos += cmd
+    else:
+      raise PackError('Invalid delta opcode')
+  data = ''.join(chunks)
+  if len(data) != target_size:
+    raise PackError('Delta target size mismatch')
+  return data
+
+
+def _EncodeDeltaVarint(value):
+  out = []
+  while value >= 0x80:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+  return ''.join(out)
+
+
+def _EncodeDeltaCopy(offset, size):
+  cmd = 0x80
+  args = []
+  for i in xrange(4):
+    byte = (offset >> (8 * i)) & 0xff
+    if byte:
+      cmd |= 1 << i
+      args.append(chr(byte))
+  for i in xrange(3):
+    byte = (size >> (8 * i)) & 0xff
+    if byte:
+      cmd |= 0x10 << i
+      args.append(chr(byte))
+  return chr(cmd) + ''.join(args)
+
+
+def _EncodeDeltaInsert(data):
+  return ''.join(chr(len(data[i:i + 127])) + data[i:i + 127]
+                 for i in xrange(0, len(data), 127))
+
+
+def _MatchLength(a, a_pos, b, b_pos):
+  """Returns the length of the common prefix of a[a_pos:] and b[b_pos:]."""
+  length = 0
+  step = 256
+  while step:
+    while (a_pos + length + step <= len(a) and b_pos + length + step <= len(b)
+           and a[a_pos + length:a_pos + length + step] ==
+               b[b_pos + length:b_pos + length + step]):
+      length += step
+    step /= 4
+  return length
+
+
+_DELTA_BLOCK = 16
+_DELTA_MAX_COPY = 0x10000
+
+
+def CreateDelta(base, target):
+  """Returns a git (pack) delta which turns base into target.
+
+  A simple greedy encoder: base is indexed in blocks of _DELTA_BLOCK bytes and
+  each block of target found in the index is extended as much as possible.
+  It works well for objects which differ in a few places, such as the versions
+  of a tree before and after a rewrite.
+  """
+  index = {}
+  for i in xrange(len(base) - _DELTA_BLOCK, -1, -_DELTA_BLOCK):
+    index[base[i:i + _DELTA_BLOCK]] = i
+  out = [_EncodeDeltaVarint(len(base)), _EncodeDeltaVarint(len(target))]
+  literal_start = 0
+  pos = 0
+  while pos + _DELTA_BLOCK <= len(target):
+    base_pos = index.get(target[pos:pos + _DELTA_BLOCK])
+    if base_pos is None:
+      pos += 1
+      continue
+    # Extend the match backwards (over the pending literal) and forwards.
+    while (pos > literal_start and base_pos > 0 and
+           target[pos - 1] == base[base_pos - 1]):
+      pos -= 1
+      base_pos -= 1
+    length = _MatchLength(target, pos, base, base_pos)
+    out.append(_EncodeDeltaInsert(target[literal_start:pos]))
+    for i in xrange(0, length, _DELTA_MAX_COPY):
+      out.append(_EncodeDeltaCopy(base_pos + i,
+                                  min(_DELTA_MAX_COPY, length - i)))
+    pos += length
+    literal_start = pos
+  out.append(_EncodeDeltaInsert(target[literal_start:]))
+  return ''.join(out)
+
+
+def _EncodePackObjHeader(objtype, size):
+  c = (objtype << 4) | (size & 15)
+  size >>= 4
+  out = []
+  while size:
+    out.append(chr(c | 0x80))
+    c = size & 0x7f
+    size >>= 7
+  out.append(chr(c))
+  return ''.join(out)
+
+
+def WritePackIndex(idx_path, entries, pack_checksum):
+  """Writes a version 2 .idx for a list of (raw_sha, offset, crc32) entries."""
+  entries = sorted(entries)
+  fanout = [0] * 256
+  for sha, _, _ in entries:
+    fanout[ord(sha[0])] += 1
+  for i in xrange(1, 256):
+    fanout[i] += fanout[i - 1]
+  offsets = array.array('I')
+  large_offsets = array.array('L')
+  for _, offset, _ in entries:
+    if offset < 0x80000000:
+      offsets.append(offset)
+    else:
+      offsets.append(0x80000000 | len(large_offsets))
+      large_offsets.append(offset)
+  crcs = array.array('I', (crc & 0xffffffff for _, _, crc in entries))
+  if sys.byteorder == 'little':
+    offsets.byteswap()
+    crcs.byteswap()
+  data = ''.join(['\377tOc', struct.pack('>I', 2),
+                  struct.pack('>256I', *fanout),
+                  ''.join(sha for sha, _, _ in entries),
+                  crcs.tostring(), offsets.tostring(),
+                  ''.join(struct.pack('>Q', off) for off in large_offsets),
+                  pack_checksum])
+  WriteFileAtomic(idx_path, data + hashlib.sha1(data).digest())
+
+
+class PackWriter(object):
+  """Streams objects into a new pack file (and its .idx) in pack_dir.
+
+  Objects are appended to a temporary file as they are added. Close() fixes
+  the object count in the header, appends the checksum and moves the pack and
+  its .idx to their final pack-<checksum> names.
+  Objects added with a base are stored as REF_DELTA against it if the delta is
+  small enough. The base is not added: if it is not in this pack, the pack is
+  thin and is not usable by git until its missing bases are added (see
+  MergePacks()).
+  """
+  def __init__(self, pack_dir, compression=1):
+    Makedirs(pack_dir)
+    self.pack_dir = pack_dir
+    self.compression = compression
+    self.size = 12
+    self.missing_bases = set()  # Raw SHA-1 of REF_DELTA bases not in the pack.
+    self._entries = {}  # raw_sha -> (offset, crc32).
+    self._tmp_path = os.path.join(pack_dir, 'tmp-pack-%d-%d.pack' % (
+        os.getpid(), id(self)))
+    self._fd = open(self._tmp_path, 'w+b')
+    self._fd.write('PACK' + struct.pack('>II', 2, 0))
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, sha):
+    return sha in self._entries
+
+  def Add(self, objtype, payload, base=None):
+    """Adds an object (if not in the pack already) and returns its SHA1.
+
+    base is an optional (SHA1, payload) of a similar object.
+    """
+    sha1 = SHA1(hashlib.sha1('%s %d\x00%s' % (objtype, len(payload),
+                                               payload)).digest())
+    if sha1.raw in self._entries:
+      return sha1
+    if base and base[0].raw != sha1.raw:
+      delta = CreateDelta(base[1], payload)
+      if len(delta) < len(payload) / 2:
+        self.AddRaw(sha1.raw, OBJ_REF_DELTA, len(delta),
+                    zlib.compress(delta, self.compression), base[0].raw)
+        return sha1
+    self.AddRaw(sha1.raw, _PACK_OBJ_TYPES[objtype], len(payload),
+                zlib.compress(payload, self.compression))
+    return sha1
+
+  def AddRaw(self, sha, objtype, size, compressed_data, base_sha=None):
+    """Appends an already compressed object (see PackFile.ReadRaw())."""
+    if sha in self._entries:
+      return
+    entry = _EncodePackObjHeader(objtype, size) + (base_sha or '')
+    crc = zlib.crc32(compressed_data, zlib.crc32(entry))
+    self._fd.write(entry)
+    self._fd.write(compressed_data)
+    self._entries[sha] = (self.size, crc)
+    self.size += len(entry) + len(compressed_data)
+    self.missing_bases.discard(sha)
+    if base_sha and base_sha not in self._entries:
+      self.missing_bases.add(base_sha)
+
+  def Close(self):
+    """Finalizes the pack and returns its path (None if no objects added)."""
+    if not self._entries:
+      self._fd.close()
+      os.remove(self._tmp_path)
+      return None
+    self._fd.seek(8)
+    self._fd.write(struct.pack('>I', len(self._entries)))
+    self._fd.flush()
+    self._fd.seek(0)
+    hasher = hashlib.sha1()
+    while True:
+      chunk = self._fd.read(1048576)
+      if not chunk:
+        break
+      hasher.update(chunk)
+    checksum = hasher.digest()
+    self._fd.write(checksum)
+    self._fd.close()
+    pack_path = os.path.join(self.pack_dir,
+                             'pack-%s.pack' % SHA1.RawToHex(checksum))
+    # The .idx first: once the tmp pack is gone, the pack is complete.
+    WritePackIndex(pack_path[:-5] + '.idx',
+                   ((sha, offset, crc) for sha, (offset, crc)
+                    in self._entries.iteritems()),
+                   checksum)
+    os.rename(self._tmp_path, pack_path)
+    self._entries = {}
+    return pack_path
+
+  def Abort(self):
+    """Discards the (not yet closed) pack."""
+    self._fd.close()
+    os.remove(self._tmp_path)
+
+
+def MergePacks(pack_paths, pack_dir, read_base=None,
+               max_pack_size=4 * 1024 * 1048576):
+  """Merges packs (e.g., from several PackWriter) into a few, self-contained.
+
+  Objects are copied without being recompressed, except OFS_DELTA (which are
+  stored undeltified). A new pack is started every max_pack_size bytes.
+  The REF_DELTA bases which end up missing in an output pack (i.e., thin packs)
+  are appended to it, taking them from the input packs or, if not there, from
+  read_base(raw_sha) -> (type_name, payload), like git index-pack --fix-thin.
+  Returns the list of paths of the new packs. The input packs are not removed.
+  """
+  db = PackDB(pack_dir, pack_paths=pack_paths)
+  out_paths = []
+  writer = None
+
+  def _FixThinAndClose(writer):
+    while writer.missing_bases:
+      base_sha = writer.missing_bases.pop()
+      pack_and_offset = db.Find(base_sha)
+      if pack_and_offset:
+        objtype, payload = pack_and_offset[0].Read(pack_and_offset[1])
+      elif read_base:
+        objtype, payload = read_base(base_sha)
+      else:
+        raise PackError('Missing delta base %s' % SHA1.RawToHex(base_sha))
+      writer.Add(objtype, payload)
+    out_paths.append(writer.Close())
+
+  try:
+    for pack in db.packs:
+      for i in pack._GetOrder():
+        sha = pack.idx.GetSHA1(i)
+        if writer is None:
+          writer = PackWriter(pack_dir)
+        if sha in writer:
+          continue
+        offset = pack.idx.offsets[i]
+        objtype, size, base, data = pack.ReadRaw(offset)
+        if objtype == OBJ_OFS_DELTA:
+          writer.Add(*pack.Read(offset))
+        else:
+          writer.AddRaw(sha, objtype, size, data,
+                        base if objtype == OBJ_REF_DELTA else None)
+        if writer.size >= max_pack_size:
+          _FixThinAndClose(writer)
+          writer = None
+    if writer:
+      _FixThinAndClose(writer)
+      writer = None
+  except:
+    if writer:
+      writer.Abort()
+    raise
+  finally:
+    db.Close()
+  return out_paths
@@ -0,0 +1,404 @@
+# -*- mode:python -*-
+# Copyright (c) 2015 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Lightweight metrics and tracing, shared by git-cs, wjet and history-rewrite.
+
+Records, per process:
+  - counters: Count('wjet.download.errors');
+  - phases (cumulative time and count): with Phase('gitcs.write'): ..., or
+    AddPhase() for the time measured elsewhere (e.g., by a pool worker);
+  - histograms (log2 buckets, e.g. of latencies): Observe(name, secs);
+  - gauges (e.g., queue depths and worker utilization): SetGauge(name, value).
+
+Pool workers ship their metrics back by piggybacking TakeUpdates() on their
+results, which the parent Merge()s. Pool initializers should call InitWorker().
+
+Everything is configured through the environment, so that worker processes
+inherit the configuration:
+  GIT_TOOLS_TRACE=path        Appends a JSON line for each Phase() and for each
+                              summary to path (one file for all the processes).
+  GIT_TOOLS_SUMMARY_SECS=N    Prints a JSON summary line to stderr every N secs
+                              (see MaybeReport()) and on exit.
+  GIT_TOOLS_PROFILE=dir       Runs a sampling profiler in the worker processes.
+                              Each one writes dir/profile.PID.txt on exit, in
+                              the "collapsed stacks" format of flamegraph.pl.
+  GIT_TOOLS_PROFILE_HZ=N      Profiler sampling rate (default: 100).
+"""
+
+import atexit
+import collections
+import json
+import math
+import multiprocessing.util
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class Histogram(object):
+  """Histogram with log2 buckets, each split in SUB_BUCKETS linear ones (i.e.,
+  <= 12% error for 4): cheap to update, to merge and to ship."""
+  __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+  SUB_BUCKETS = 4
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self.buckets = collections.defaultdict(int)  # See _GetBucket().
+
+  @staticmethod
+  def _GetBucket(value):
+    if value <= 0:
+      return None
+    mantissa, exp = math.frexp(value)  # value = mantissa * 2^exp, m in [.5, 1)
+    return exp * Histogram.SUB_BUCKETS + int(
+        (mantissa - 0.5) * 2 * Histogram.SUB_BUCKETS)
+
+  @staticmethod
+  def _GetUpperBound(bucket):
+    exp, sub_bucket = divmod(bucket, Histogram.SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_bucket + 1) * 0.5 / Histogram.SUB_BUCKETS, exp)
+
+  def Add(self, value):
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    self.buckets[Histogram._GetBucket(value)] += 1
+
+  def Merge(self, other):
+    self.count += other.count
+    self.total += other.total
+    for attr, fn in (('min', min), ('max', max)):
+      values = [v for v in (getattr(self, attr), getattr(other, attr))
+                if v is not None]
+      setattr(self, attr, fn(values) if values else None)
+    for bucket, count in other.buckets.iteritems():
+      self.buckets[bucket] += count
+
+  def Percentile(self, pct):
+    """Returns the upper bound of the bucket containing the pct-th value."""
+    threshold = self.count * pct / 100.0
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= threshold:
+        if bucket is None:
+          return 0.0
+        return min(Histogram._GetUpperBound(bucket), self.max)
+    return self.max
+
+  def ToDict(self):
+    return {'count': self.count, 'mean': self.total / max(self.count, 1),
+            'min': self.min, 'max': self.max, 'p50': self.Percentile(50),
+            'p90': self.Percentile(90), 'p99': self.Percentile(99)}
+
+
+class _Gauge(object):
+  __slots__ = ('last', 'max', 'total', 'samples')
+
+  def __init__(self):
+    self.last = self.max = None
+    self.total = 0.0
+    self.samples = 0
+
+  def Set(self, value):
+    self.last = value
+    self.max = value if self.max is None else max(self.max, value)
+    self.total += value
+    self.samples += 1
+
+  def ToDict(self):
+    return {'last': self.last, 'max': self.max,
+            'avg': self.total / max(self.samples, 1)}
+
+
+class _Config(object):
+  def __init__(self):
+    self.trace_path = os.getenv('GIT_TOOLS_TRACE')
+    summary_secs = os.getenv('GIT_TOOLS_SUMMARY_SECS')
+    self.summary_secs = float(summary_secs) if summary_secs else None
+    self.profile_dir = os.getenv('GIT_TOOLS_PROFILE')
+    self.profile_hz = float(os.getenv('GIT_TOOLS_PROFILE_HZ', 100))
+
+
+_config = _Config()
+_owner_pid = os.getpid()  # The process the metrics below belong to.
+_start_time = time.time()
+_last_report_time = _start_time
+_counters = collections.defaultdict(int)
+_phases = collections.defaultdict(lambda: [0, 0.0])  # name -> [count, secs]
+_histograms = collections.defaultdict(Histogram)
+_gauges = collections.defaultdict(_Gauge)
+_trace_fd = None
+_trace_buf = []
+_trace_lock = threading.Lock()  # For the worker threads of ThreadPool(s).
+_profiler = None
+
+
+def Configure(trace_path=None, summary_secs=None, profile_dir=None):
+  """Overrides the configuration from the environment (for the arguments
+  which are not None). Call before starting the worker pools."""
+  if trace_path is not None:
+    _config.trace_path = trace_path
+    os.environ['GIT_TOOLS_TRACE'] = trace_path
+  if summary_secs is not None:
+    _config.summary_secs = summary_secs
+  if profile_dir is not None:
+    _config.profile_dir = profile_dir
+    os.environ['GIT_TOOLS_PROFILE'] = profile_dir
+
+
+def IsSummaryEnabled():
+  return bool(_config.summary_secs)
+
+
+def Count(name, value=1):
+  _counters[name] += value
+
+
+def AddPhase(name, secs, count=1):
+  phase = _phases[name]
+  phase[0] += count
+  phase[1] += secs
+
+
+def GetPhaseSecs(name):
+  """Returns the time accumulated so far by the phase (e.g., to derive the
+  utilization of the workers of a pool)."""
+  return _phases[name][1] if name in _phases else 0.0
+
+
+def Observe(name, value):
+  _histograms[name].Add(value)
+
+
+def SetGauge(name, value):
+  _gauges[name].Set(value)
+
+
+class Phase(object):
+  """Context manager which times a phase and, if tracing, traces it."""
+  __slots__ = ('name', 'start')
+
+  def __init__(self, name):
+    self.name = name
+    self.start = None
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *_):
+    secs = time.time() - self.start
+    AddPhase(self.name, secs)
+    if _config.trace_path:
+      _Trace({'type': 'phase', 'name': self.name, 'ts': self.start,
+              'dur': secs})
+
+
+def TimedIter(name, iterable):
+  """Yields from iterable, timing the time spent waiting for each item as the
+  phase name. Useful to time the stages of a pipeline of generators."""
+  iterator = iter(iterable)
+  while True:
+    tstart = time.time()
+    try:
+      item = next(iterator)
+    except StopIteration:
+      AddPhase(name, time.time() - tstart, 0)
+      return
+    AddPhase(name, time.time() - tstart)
+    yield item
+
+
+def Snapshot():
+  """Returns all the metrics of this process as a (JSON-able) dict."""
+  return {
+      'counters': dict(_counters),
+      'phases': dict((name, {'count': count, 'secs': secs})
+                     for name, (count, secs) in _phases.iteritems()),
+      'histograms': dict((name, hist.ToDict())
+                         for name, hist in _histograms.iteritems()),
+      'gauges': dict((name, gauge.ToDict())
+                     for name, gauge in _gauges.iteritems()),
+  }
+
+
+def _Reset():
+  _counters.clear()
+  _phases.clear()
+  _histograms.clear()
+  _gauges.clear()
+
+
+def TakeUpdates():
+  """Returns (and forgets) the counters, phases and histograms recorded so far
+  (in a worker), to be Merge()d by the parent. Gauges are not shipped."""
+  updates = (dict(_counters), dict(_phases), dict(_histograms))
+  _counters.clear()
+  _phases.clear()
+  _histograms.clear()
+  return updates
+
+
+def Merge(updates):
+  counters, phases, histograms = updates
+  for name, value in counters.iteritems():
+    _counters[name] += value
+  for name, (count, secs) in phases.iteritems():
+    AddPhase(name, secs, count)
+  for name, hist in histograms.iteritems():
+    _histograms[name].Merge(hist)
+
+
+def _Trace(event):
+  global _trace_fd
+  event['pid'] = _owner_pid
+  line = json.dumps(event, separators=(',', ':')) + '\n'
+  with _trace_lock:
+    if _trace_fd is None:
+      # O_APPEND: the lines written by the different processes don't overlap.
+      _trace_fd = os.open(_config.trace_path,
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    _trace_buf.append(line)
+    if len(_trace_buf) >= 256:
+      _FlushTrace()
+
+
+def _FlushTrace():
+  """Must be called with _trace_lock held."""
+  if _trace_buf:
+    os.write(_trace_fd, ''.join(_trace_buf))
+    del _trace_buf[:]
+
+
+def Report(to_stderr=True):
+  """Emits a summary of the metrics, to stderr and/or to the trace."""
+  global _last_report_time
+  now = time.time()
+  _last_report_time = now
+  summary = Snapshot()
+  summary.update({'type': 'summary', 'ts': now, 'elapsed': now - _start_time})
+  if _config.trace_path:
+    _Trace(summary)
+    with _trace_lock:
+      _FlushTrace()
+  if _config.summary_secs and to_stderr:
+    summary['pid'] = _owner_pid
+    sys.stderr.write(json.dumps(summary, sort_keys=True) + '\n')
+
+
+def MaybeReport():
+  """Calls Report() if GIT_TOOLS_SUMMARY_SECS have passed since the last one.
+  Cheap, meant to be called from the progress loops of the tools."""
+  if (_config.summary_secs and
+      time.time() - _last_report_time >= _config.summary_secs):
+    Report()
+
+
+class _SamplingProfiler(object):
+  """Samples the stacks of all the threads on SIGPROF (i.e., every 1/hz secs
+  of CPU time) and counts them by their "collapsed" representation."""
+
+  def __init__(self, hz):
+    self.interval = 1.0 / hz
+    self.stacks = collections.defaultdict(int)
+
+  def Start(self):
+    signal.signal(signal.SIGPROF, self._Sample)
+    # Don't fail the blocking syscalls of the sampled code with EINTR.
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+  def Stop(self):
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+  def _Sample(self, _signum, interrupted_frame):
+    frames = sys._current_frames()
+    # The signal handler runs on the main thread: skip its own frame.
+    frames[threading.current_thread().ident] = interrupted_frame
+    for frame in frames.itervalues():
+      stack = []
+      while frame:
+        code = frame.f_code
+        stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+      self.stacks[';'.join(reversed(stack))] += 1
+
+  def Save(self, path):
+    with open(path, 'w') as out:
+      for stack, count in sorted(self.stacks.iteritems()):
+        out.write('%s %d\n' % (stack, count))
+
+
+def InitWorker():
+  """To be called by the initializer of pool workers (once per process).
+
+  The metrics inherited from the parent are dropped, the profiler started (if
+  GIT_TOOLS_PROFILE is set) and, on exit, the profile is saved and the metrics
+  not shipped back via TakeUpdates() are traced.
+  """
+  global _owner_pid, _trace_fd, _trace_lock, _profiler, _start_time
+  if os.getpid() == _owner_pid:
+    return  # Thread pools or repeated calls.
+  _owner_pid = os.getpid()
+  _start_time = time.time()
+  _trace_fd = None
+  _trace_lock = threading.Lock()  # Might have been forked while held.
+  del _trace_buf[:]  # The parent's, it will flush them.
+  _Reset()
+  if _config.profile_dir:
+    _profiler = _SamplingProfiler(_config.profile_hz)
+    _profiler.Start()
+  multiprocessing.util.Finalize(None, _FinalizeWorker, exitpriority=5)
+
+
+def _FinalizeWorker():
+  if _profiler:
+    _profiler.Stop()
+    _profiler.Save(os.path.join(_config.profile_dir,
+                                'profile.%d.txt' % os.getpid()))
+  if _config.trace_path and (_counters or _phases or _histograms):
+    Report(to_stderr=False)
+  elif _trace_fd is not None:
+    with _trace_lock:
+      _FlushTrace()
+
+
+@atexit.register
+def _OnExit():
+  if os.getpid() != _owner_pid:
+    return  # A forked process which didn't call InitWorker().
+  if _config.trace_path or _config.summary_secs:
+    Report()
@@ -24,41 +24,150 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
 import httplib
 import logging
 import multiprocessing
+import multiprocessing.pool
 import os
+import random
+import socket
 import sys
+import threading
 import time
 import zlib
 import optparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'instrument'))
+import instrument
 
-#TODO detect hung connections.
 
 _ZLIB_WINDOW_BUFFER_SIZE = 16 + zlib.MAX_WBITS
 
+# Partial downloads smaller than this are restarted from scratch rather than
+# resumed with a Range request.
+_MIN_RESUME_BYTES = 1048576
+
+# When the size of a (gzip or chunked) download is not known upfront, up to this
+# many bytes are kept in memory to compute its Git blob SHA-1 (which requires
+# the size first) at the end. Larger files are re-read from disk instead.
+_MAX_HASH_BUFFER_BYTES = 16 * 1048576
+
+# Uploads larger than this are streamed from the file rather than read upfront.
+_MIN_STREAM_UPLOAD_BYTES = 1048576
+
+# 'process' runs one process per connection. 'thread' runs one thread per
+# connection in the current process, which scales to hundreds of connections
+# (socket I/O, zlib and hashlib all release the GIL).
+ENGINES = ('process', 'thread')
+
+# Per-worker (i.e. per connection) state. Being thread-local, this works both
+# for the worker processes and for the worker threads of the 'thread' engine.
+_worker_state = threading.local()
+
 
 class DownloadManyException(Exception):
   pass
 
 
+class RetryPolicy(object):
+  """Controls the timeouts and the retries of each download job.
+
+  timeout_sec bounds how long a connect() or a single read from the socket can
+  stall before the connection is considered hung. Failed attempts are retried
+  after an exponential backoff with (full) jitter, capped to max_backoff_sec.
+  """
+  def __init__(self, max_attempts=5, backoff_sec=0.5, max_backoff_sec=30,
+               timeout_sec=60):
+    self.max_attempts = max_attempts
+    self.backoff_sec = backoff_sec
+    self.max_backoff_sec = max_backoff_sec
+    self.timeout_sec = timeout_sec
+
+  def GetBackoff(self, retry):
+    return random.uniform(0, min(self.max_backoff_sec,
+                                 self.backoff_sec * (2 ** retry)))
+
+
+class JobError(object):
+  HTTP = 'http'  # Non-2xx response. status contains the HTTP status code.
+  TIMEOUT = 'timeout'  # The connection stalled for more than timeout_sec.
+  NETWORK = 'network'  # Socket errors, truncated or malformed responses.
+  IO = 'io'  # Errors while reading or writing the local file.
+  SHA1_MISMATCH = 'sha1_mismatch'
+
+  def __init__(self, kind, message='', status=None, retriable=True):
+    self.kind = kind
+    self.message = message
+    self.status = status
+    self.retriable = retriable
+
+  def __str__(self):
+    return '[%s] %s' % (self.kind, self.message or self.status)
+
+
 class DownloadJobResult:
-  def __init__(self, remote_path, local_path):
+  def __init__(self, remote_path, local_path, expected_sha1=None):
     self.remote_path = remote_path
     self.local_path = local_path
+    self.expected_sha1 = expected_sha1
+    self.sha1 = None  # Git blob SHA-1, computed only if expected_sha1 is set.
     self.bytes_downloaded = 0
     self.bytes_written = 0
-    self.error = 0  # TODO restructure
+    self.attempts = 0
+    self.elapsed = 0  # Seconds, all the attempts included.
+    self.verify_secs = 0  # Spent finalizing / re-hashing the SHA1.
+    self.error = None  # A JobError if the last attempt failed.
+
+
+class UploadJobResult:
+  def __init__(self, local_path, remote_path):
+    self.local_path = local_path
+    self.remote_path = remote_path
+    self.bytes_uploaded = 0
+    self.attempts = 0
+    self.elapsed = 0  # Seconds, all the attempts included.
+    self.error = None  # A JobError if the last attempt failed.
+
+
+class ExistsJobResult:
+  def __init__(self, remote_path):
+    self.remote_path = remote_path
+    self.exists = None  # True / False, None if the request failed.
+    self.attempts = 0
+    self.elapsed = 0  # Seconds, all the attempts included.
+    self.error = None  # A JobError if the last attempt failed.
+
+
+def _GetGitBlobSHA1(path):
+  hlib = hashlib.sha1()
+  hlib.update('blob %d\x00' % os.path.getsize(path))
+  _HashFile(hlib, path)
+  return hlib.hexdigest()
+
+
+def _HashFile(hlib, path):
+  IO_BLOCK_SIZE = 65536
+  with open(path, 'rb') as fd:
+    while True:
+      data = fd.read(IO_BLOCK_SIZE)
+      if not data:
+        break
+      hlib.update(data)
 
 
 def _GetCurrentWorker():
-  return multiprocessing.current_process()
+  return _worker_state
 
 
-def _InitWorker(host):
+def _InitWorker(host, retry_policy, headers, use_proxy=True):
   _GetCurrentWorker()._http_host = host
+  _GetCurrentWorker()._use_proxy = use_proxy
+  _GetCurrentWorker()._retry_policy = retry_policy
+  _GetCurrentWorker()._http_headers = headers or {}
   _ResetConnectionForCurrentWorker()
+  instrument.InitWorker()
 
 
 def _ResetConnectionForCurrentWorker():
@@ -68,81 +177,329 @@ def _ResetConnectionForCurrentWorker():
   except:
     pass
 
-  proxy = os.getenv('GITCS_PROXY')
+  proxy = os.getenv('GITCS_PROXY') if worker._use_proxy else None
+  timeout = worker._retry_policy.timeout_sec
   worker._http_req_prefix = ''
   if proxy:
-    worker._http_conn = httplib.HTTPSConnection(proxy)
+    worker._http_conn = httplib.HTTPSConnection(proxy, timeout=timeout)
     worker._http_req_prefix = worker._http_host
   elif worker._http_host.startswith('https://'):
-    worker._http_conn = httplib.HTTPSConnection(worker._http_host[8:])
+    worker._http_conn = httplib.HTTPSConnection(worker._http_host[8:],
+                                                timeout=timeout)
   else:
     host = worker._http_host.replace('http://', '')
-    worker._http_conn = httplib.HTTPConnection(host)
+    worker._http_conn = httplib.HTTPConnection(host, timeout=timeout)
 
 
-# TODO Wrap and return error as part of the job result
-def _DownloadWorkerJob(args):
+def _RemoveIfExists(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+def _GetRequestHeaders(**kwargs):
+  headers = {'Connection': 'keep-alive'}
+  headers.update(_GetCurrentWorker()._http_headers)
+  headers.update(kwargs)
+  return headers
+
+
+def _HttpError(resp):
+  resp.read()  # Unblock for the next request.
+  # Retrying can help only with server-side (5xx) or throttling errors.
+  retriable = resp.status >= 500 or resp.status in (
+      httplib.REQUEST_TIMEOUT, httplib.REQUESTED_RANGE_NOT_SATISFIABLE, 429)
+  return JobError(JobError.HTTP, status=resp.status, retriable=retriable)
+
+
+def _RunWithRetries(res, attempt_fn, *args):
+  """Runs attempt_fn(res, *args) until it succeeds (i.e. returns None).
+
+  attempt_fn returns None on success or a JobError. Network errors and
+  timeouts are turned into a JobError as well. Retries are done according to
+  the RetryPolicy of the current worker.
+  """
+  policy = _GetCurrentWorker()._retry_policy
+  tstart = time.time()
+  while True:
+    res.attempts += 1
+    try:
+      res.error = attempt_fn(res, *args)
+    except socket.timeout as e:
+      res.error = JobError(JobError.TIMEOUT, str(e))
+    except (socket.error, httplib.HTTPException) as e:
+      res.error = JobError(JobError.NETWORK, '%s %s' % (type(e).__name__, e))
+    except EnvironmentError as e:
+      res.error = JobError(JobError.IO, str(e), retriable=False)
+    if not res.error:
+      break
+
+    # Never reuse a connection after a failure, it might be in a weird state.
+    _ResetConnectionForCurrentWorker()
+    if not res.error.retriable or res.attempts >= policy.max_attempts:
+      break
+    time.sleep(policy.GetBackoff(res.attempts - 1))
+  res.elapsed = time.time() - tstart
+  return res
+
+
+def _DownloadAttempt(res, part_path):
+  """Downloads (the rest of) res.remote_path into part_path.
+
+  On retries, if part_path contains at least _MIN_RESUME_BYTES from a previous
+  attempt, they are kept and only the remaining bytes are requested, using a
+  Range request. In this case the server is asked not to gzip the response, as
+  the range applies to the encoded representation.
+  Returns None on success or a JobError.
+  """
   IO_BLOCK_SIZE = 16384
-  remote_path, local_path = args
-  res = DownloadJobResult(remote_path, local_path)
   worker = _GetCurrentWorker()
-  for retry_backoff_sec in [0.1, 0]:  ###################################### [0.5, 2, 5]
-    conn = worker._http_conn
-    conn.request('GET', worker._http_req_prefix + remote_path,
-        headers={'Connection': 'keep-alive', 'Accept-Encoding': 'gzip'})
-    resp = conn.getresponse(buffering=True)
-
-    # Retry logic.
-    if resp.status != httplib.OK:
-      res.error = resp.status
-      if resp.status == 404:
-        resp.read()  # Unblock for the next request.
-        break  # Very unlikely that retrying will help in this case.
-      # logging.warning('Request %s failed with error %s, retrying in %s sec.',
-      #     remote_path, resp.status, retry_backoff_sec)
-      time.sleep(retry_backoff_sec)
-      _ResetConnectionForCurrentWorker()
-      continue
-
-    zdec = None
-    if resp.getheader('content-encoding') == 'gzip':
-      zdec = zlib.decompressobj(_ZLIB_WINDOW_BUFFER_SIZE)
-    with open(local_path, 'wb') as local_fd:
+  offset = 0
+  if res.attempts > 1 and os.path.exists(part_path):
+    offset = os.path.getsize(part_path)
+    offset = offset if offset >= _MIN_RESUME_BYTES else 0
+  headers = _GetRequestHeaders()
+  if offset:
+    headers['Range'] = 'bytes=%d-' % offset
+  else:
+    headers['Accept-Encoding'] = 'gzip'
+  conn = worker._http_conn
+  conn.request('GET', worker._http_req_prefix + res.remote_path,
+               headers=headers)
+  resp = conn.getresponse(buffering=True)
+
+  if offset and resp.status == httplib.PARTIAL_CONTENT:
+    content_range = resp.getheader('content-range', '')
+    if not content_range.startswith('bytes %d-' % offset):
+      resp.read()
+      _RemoveIfExists(part_path)  # Start from scratch on the next attempt.
+      return JobError(JobError.NETWORK,
+                      'Unexpected Content-Range: ' + content_range)
+  elif resp.status == httplib.OK:
+    offset = 0  # The server doesn't support ranges (or wasn't asked to).
+  else:
+    if resp.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+      _RemoveIfExists(part_path)
+    return _HttpError(resp)
+
+  zdec = None
+  if resp.getheader('content-encoding') == 'gzip':
+    zdec = zlib.decompressobj(_ZLIB_WINDOW_BUFFER_SIZE)
+  content_length = resp.getheader('content-length')
+  bytes_received = 0
+
+  # The Git blob SHA-1 requires the (decompressed) size upfront. If that is
+  # known, hash while writing (after the bytes kept from a previous attempt),
+  # otherwise keep the data in |hash_buf| and hash it once complete.
+  hlib = None
+  hash_buf = None
+  if res.expected_sha1:
+    total_size = None
+    if offset:
+      total_size = resp.getheader('content-range', '').rpartition('/')[2]
+    elif not zdec:
+      total_size = content_length
+    if total_size and total_size.isdigit():
+      hlib = hashlib.sha1('blob %s\x00' % total_size)
+      if offset:
+        _HashFile(hlib, part_path)
+    elif not offset:
+      hash_buf = []
+    # else: resumed with an unknown total ('bytes a-b/*'), hash the whole file
+    # once complete, as the buffer would miss the bytes kept from before.
+  hash_buf_size = 0
+
+  with open(part_path, 'ab' if offset else 'wb') as local_fd:
+    try:
       while True:
         data = resp.read(IO_BLOCK_SIZE)
-        data_len = len(data)
-        if data_len:
-          res.bytes_downloaded += data_len
-          if zdec:
-            dec_data = zdec.decompress(data)
-          else:
-            dec_data = data
-          res.bytes_written += len(dec_data)
-          local_fd.write(dec_data)
-        if data_len < IO_BLOCK_SIZE:
-          if zdec:
-            dec_data = zdec.flush()
-            local_fd.write(dec_data)
-            res.bytes_written += len(dec_data)
+        if not data:
           break
+        bytes_received += len(data)
+        res.bytes_downloaded += len(data)
+        dec_data = zdec.decompress(data) if zdec else data
+        res.bytes_written += len(dec_data)
+        local_fd.write(dec_data)
+        if hlib:
+          hlib.update(dec_data)
+        elif hash_buf is not None:
+          hash_buf.append(dec_data)
+          hash_buf_size += len(dec_data)
+          if hash_buf_size > _MAX_HASH_BUFFER_BYTES:
+            hash_buf = None  # Too large, will be re-read from disk.
+      if zdec:
+        dec_data = zdec.flush()
+        local_fd.write(dec_data)
+        res.bytes_written += len(dec_data)
+        if hlib:
+          hlib.update(dec_data)
+        elif hash_buf is not None:
+          hash_buf.append(dec_data)
+    except zlib.error as e:
+      _RemoveIfExists(part_path)  # Can't resume a corrupted gzip stream.
+      return JobError(JobError.NETWORK, 'zlib: %s' % e)
+
+  if content_length is not None and bytes_received != int(content_length):
+    return JobError(JobError.NETWORK, 'Truncated response (%d / %s bytes)' % (
+        bytes_received, content_length))
+
+  if res.expected_sha1:
+    verify_start = time.time()
+    if hlib:
+      res.sha1 = hlib.hexdigest()
+    elif hash_buf is not None:
+      hlib = hashlib.sha1('blob %d\x00' % sum(len(d) for d in hash_buf))
+      for dec_data in hash_buf:
+        hlib.update(dec_data)
+      res.sha1 = hlib.hexdigest()
+    else:
+      res.sha1 = _GetGitBlobSHA1(part_path)
+    res.verify_secs += time.time() - verify_start
+    if res.sha1 != res.expected_sha1:
+      _RemoveIfExists(part_path)
+      # A mismatch after resuming might be caused by the object changing
+      # between the two requests, so it is worth another (full) attempt.
+      return JobError(JobError.SHA1_MISMATCH,
+                      'SHA1 mismatch (got %s)' % res.sha1,
+                      retriable=bool(offset))
+  os.rename(part_path, res.local_path)
+  return None
+
+
+def _DownloadWorkerJob(args):
+  """Downloads remote_path into local_path.
+
+  args is a tuple (remote_path, local_path[, expected_sha1]). The data is
+  written into local_path.part, which is renamed into local_path only once
+  the download is complete and, if expected_sha1 is given, its Git blob SHA-1
+  matches. Failed attempts are retried according to the worker RetryPolicy,
+  resuming from the partial .part file where possible.
+  """
+  remote_path, local_path = args[0:2]
+  expected_sha1 = args[2] if len(args) > 2 else None
+  res = DownloadJobResult(remote_path, local_path, expected_sha1)
+  part_path = local_path + '.part'
+  _RunWithRetries(res, _DownloadAttempt, part_path)
+  if res.error:
+    _RemoveIfExists(part_path)
   return res
 
 
-def DownloadMany(host, iterable, jobs=8):
-  pool = multiprocessing.Pool(jobs, initializer=_InitWorker, initargs=[host])
-  for job_result in pool.imap_unordered(_DownloadWorkerJob, iterable):
+def _UploadAttempt(res):
+  worker = _GetCurrentWorker()
+  size = os.path.getsize(res.local_path)
+  headers = _GetRequestHeaders(**{'Content-Length': str(size),
+                                  'Content-Type': 'application/octet-stream'})
+  with open(res.local_path, 'rb') as local_fd:
+    # Small bodies are sent in the same write() of the headers, rather than
+    # streamed, which would stall on Nagle + delayed ACK for each request.
+    body = local_fd.read() if size < _MIN_STREAM_UPLOAD_BYTES else local_fd
+    worker._http_conn.request('PUT', worker._http_req_prefix + res.remote_path,
+                              body=body, headers=headers)
+  resp = worker._http_conn.getresponse(buffering=True)
+  if resp.status not in (httplib.OK, httplib.CREATED):
+    return _HttpError(resp)
+  resp.read()
+  res.bytes_uploaded += size
+  return None
+
+
+def _UploadWorkerJob(args):
+  """Uploads local_path to remote_path (args is a tuple of the two) via PUT."""
+  local_path, remote_path = args
+  return _RunWithRetries(UploadJobResult(local_path, remote_path),
+                         _UploadAttempt)
+
+
+def _ExistsAttempt(res):
+  worker = _GetCurrentWorker()
+  worker._http_conn.request('HEAD', worker._http_req_prefix + res.remote_path,
+                            headers=_GetRequestHeaders())
+  resp = worker._http_conn.getresponse(buffering=True)
+  if resp.status not in (httplib.OK, httplib.NOT_FOUND):
+    return _HttpError(resp)
+  resp.read()
+  res.exists = resp.status == httplib.OK
+  return None
+
+
+def _ExistsWorkerJob(remote_path):
+  return _RunWithRetries(ExistsJobResult(remote_path), _ExistsAttempt)
+
+
+def _RunMany(job_fn, name, host, iterable, jobs, engine, retry_policy, headers,
+             chunksize=1, use_proxy=True):
+  """Runs job_fn on the iterable items. The metrics are recorded (see the
+  instrument module) as wjet.<name>.*"""
+  retry_policy = retry_policy or RetryPolicy()
+  jobs = jobs or multiprocessing.cpu_count()  # As the pools do for None.
+  if engine == 'thread':
+    pool_class = multiprocessing.pool.ThreadPool
+  elif engine == 'process':
+    pool_class = multiprocessing.Pool
+  else:
+    raise DownloadManyException('Unknown engine ' + engine)
+  pool = pool_class(jobs, initializer=_InitWorker,
+                    initargs=[host, retry_policy, headers, use_proxy])
+  prefix = 'wjet.%s.' % name
+  tstart = time.time()
+  busy_secs = 0
+  for job_result in pool.imap_unordered(job_fn, iterable, chunksize):
+    verify_secs = getattr(job_result, 'verify_secs', 0)
+    instrument.AddPhase(prefix + 'request', job_result.elapsed - verify_secs)
+    if verify_secs:
+      instrument.AddPhase(prefix + 'verify', verify_secs)
+    instrument.Observe(prefix + 'latency', job_result.elapsed)
+    instrument.Count(prefix + 'retries', job_result.attempts - 1)
+    if job_result.error:
+      instrument.Count(prefix + 'errors')
+    busy_secs += job_result.elapsed
+    instrument.SetGauge(prefix + 'utilization',
+                        busy_secs / jobs / max(time.time() - tstart, 1e-3))
     yield job_result
   pool.close()
   pool.join()
 
 
+def DownloadMany(host, iterable, jobs=8, engine='process', retry_policy=None,
+                 headers=None, use_proxy=True):
+  """Downloads (remote_path, local_path[, sha1]) tuples. Yields the results
+  (DownloadJobResult) in completion order.
+
+  host is [http[s]://]hostname[:port], remote_path(s) are absolute. Unless
+  use_proxy is False, the requests go through $GITCS_PROXY, if set.
+  """
+  return _RunMany(_DownloadWorkerJob, 'download', host, iterable, jobs, engine,
+                  retry_policy, headers, use_proxy=use_proxy)
+
+
+def UploadMany(host, iterable, jobs=8, engine='thread', retry_policy=None,
+               headers=None):
+  """Uploads (local_path, remote_path) tuples. Yields UploadJobResult(s)."""
+  return _RunMany(_UploadWorkerJob, 'upload', host, iterable, jobs, engine,
+                  retry_policy, headers)
+
+
+def CheckExistMany(host, remote_paths, jobs=8, engine='thread',
+                   retry_policy=None, headers=None):
+  """Checks (via HEAD requests) which remote_paths exist on the host.
+
+  The paths are sent to the workers in batches (to save IPC round-trips),
+  each worker issues its HEAD requests one at a time on its keep-alive
+  connection. Yields ExistsJobResult(s).
+  """
+  return _RunMany(_ExistsWorkerJob, 'exists', host, remote_paths, jobs, engine,
+                  retry_policy, headers, chunksize=16)
+
+
 def _StdinReader():
   while True:
     line = sys.stdin.readline().rstrip('\r\n')
     if not line:
       break
-    parts = line.split(' ', 2)
-    if len(parts) != 2 or not parts[0].startswith('/'):
+    parts = line.split(' ', 3)
+    if len(parts) not in (2, 3) or not parts[0].startswith('/'):
       print 'Malformed input line, skipping:\n' + line + '\n'
     else:
       yield parts
@@ -161,6 +518,12 @@ def main():
 
   parser = optparse.OptionParser(usage='%prog [options] host')
   parser.add_option('-j', '--jobs', type='int', default=None)
+  parser.add_option('-e', '--engine', choices=ENGINES, default='process',
+                    help='One of: %s (default: %%default)' % ', '.join(ENGINES))
+  parser.add_option('--timeout', type='float', default=60,
+                    help='Max seconds a connection can stall (%default)')
+  parser.add_option('--attempts', type='int', default=5,
+                    help='Max attempts per file (%default)')
   options, args = parser.parse_args()
   if len(args) != 1:
     parser.print_usage()
@@ -178,7 +541,10 @@ def main():
   print '  Completed  | Down. [MB] | Speed [MB/s] | Z.ratio | Errors '
   print '-------------+------------+--------------+---------+--------'
   last_stats_update = 0
-  for res in DownloadMany(host, _StdinReader(), options.jobs):
+  retry_policy = RetryPolicy(max_attempts=options.attempts,
+                             timeout_sec=options.timeout)
+  for res in DownloadMany(host, _StdinReader(), options.jobs, options.engine,
+                          retry_policy):
     total_bytes_downloaded += res.bytes_downloaded
     total_bytes_written += res.bytes_written
     if not res.error:
@@ -196,6 +562,7 @@ def main():
                                                     mb / time_elapsed,
                                                     compr_ratio,
                                                     errors)
+      instrument.MaybeReport()
 
   return 0 if not errors else 1
 